@@ -1,6 +1,7 @@
 from travel import forms
 from travel.models import TravelLog
 from django.contrib.sites.models import Site
+from django.utils.functional import SimpleLazyObject
 
 
 #-------------------------------------------------------------------------------
@@ -11,7 +12,7 @@ def _checklist(user):
 #-------------------------------------------------------------------------------
 def search(request):
     return {
-        'site': Site.objects.get_current(),
+        'site': SimpleLazyObject(Site.objects.get_current),
         'search_form': forms.SearchForm(),
-        'checklist': _checklist(request.user)
+        'checklist': SimpleLazyObject(lambda: _checklist(request.user))
     }
\ No newline at end of file
@@ -1,5 +1,10 @@
 import json
+import hashlib
+from django.core.cache import cache
+from django.http import HttpResponse
 from django.shortcuts import render
+from django.utils import timezone
+from django.views.decorators.http import condition
 from travel import models as travel
 
 FLAG_GROUPS = [
@@ -72,16 +77,46 @@ FLAG_GROUPS = [
 
 EXCLUDED_IDS = [u'BV', u'CA', u'GF', u'HM', u'YT', u'RE', u'SJ', u'US', u'UM', u'WF']
 
+FLAG_GAME_CACHE_KEY = 'travel:flag_game'
+
+
 #-------------------------------------------------------------------------------
-def get_flag_game_data():
+def build_flag_game_data():
     countries = dict([
         (co.code, {"name": co.name, "id": co.code, "small": co.flag.thumb.url, "large": co.flag.large.url})
         for co in travel.TravelEntity.objects.countries().exclude(code__in=EXCLUDED_IDS).select_related('flag')
     ])
-    return {'countries': json.dumps(countries), 'groups': json.dumps(FLAG_GROUPS)}
+    content = json.dumps({'countries': countries, 'groups': FLAG_GROUPS}, sort_keys=True)
+    return {
+        'content': content,
+        'etag': hashlib.md5(content).hexdigest(),
+        'last_modified': timezone.now()
+    }
+
+
+#-------------------------------------------------------------------------------
+def get_flag_game_data():
+    data = cache.get(FLAG_GAME_CACHE_KEY)
+    if data is None:
+        data = build_flag_game_data()
+        cache.set(FLAG_GAME_CACHE_KEY, data, None)
+    return data
+
+
+#-------------------------------------------------------------------------------
+def invalidate_flag_game_data():
+    cache.delete(FLAG_GAME_CACHE_KEY)
+
 
 #-------------------------------------------------------------------------------
 def flag_game(request):
-    data = get_flag_game_data()
-    return render(request, 'travel/quiz/flags.html', data)
+    return render(request, 'travel/quiz/flags.html')
+
 
+#-------------------------------------------------------------------------------
+@condition(
+    etag_func=lambda request: get_flag_game_data()['etag'],
+    last_modified_func=lambda request: get_flag_game_data()['last_modified']
+)
+def flag_game_data(request):
+    return HttpResponse(get_flag_game_data()['content'], content_type='application/json')
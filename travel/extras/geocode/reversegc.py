@@ -1,10 +1,16 @@
 import os
 import sys
 import csv
+import time
+import weakref
+import datetime
+import numpy
 from scipy.spatial import cKDTree as KDTree
+from travel.utils import EARTH_RADIUS_KM
 if 1:
     try:
         from django.db.models import Q
+        from django.db.models.signals import post_delete
         from travel.models import TravelEntity
     except ImportError:
         TravelEntity = None
@@ -12,13 +18,32 @@ if 1:
 # location of geocode data to download
 GEOCODE_URL = 'http://download.geonames.org/export/dump/cities1000.zip'
 
+BULK_CHUNK_SIZE = 500000
+
+
+def unit_vectors(coordinates):
+    """Embed (lat, lon) degree pairs as points on the unit sphere, so that
+    Euclidean nearest neighbours are also great-circle nearest neighbours
+    """
+    coordinates = numpy.radians(numpy.asarray(coordinates, dtype='f8').reshape(-1, 2))
+    lat, lon = coordinates[:, 0], coordinates[:, 1]
+    cos_lat = numpy.cos(lat)
+    return numpy.column_stack((cos_lat * numpy.cos(lon), cos_lat * numpy.sin(lon), numpy.sin(lat)))
+
+
+def chord_to_km(chords):
+    """Convert unit sphere chord lengths to great-circle distances
+    """
+    return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.clip(chords / 2, 0, 1))
+
+
 def geo_loader():
     """Singleton pattern to avoid loading class multiple times
     """
     _instances = {}
     def _loader(cls_name, *args, **kws):
         
-        cls = dict(csv=CSVGeocodeData, travel=TravelGeocodeData)[cls_name]
+        cls = dict(csv=CSVGeocodeData, mapped=MappedGeocodeData, travel=TravelGeocodeData)[cls_name]
         key = (cls_name, args, tuple(kws.items()))
         if key not in _instances:
             _instances[key] = cls(*args, **kws)
@@ -31,6 +56,15 @@ def relative_path(fn):
     return os.path.join(os.path.dirname(__file__), fn)
 
 
+def load_country_names(filename):
+    """Load a map of country code to name
+    """
+    countries = {}
+    for code, name in csv.reader(open(filename)):
+        countries[code] = name
+    return countries
+
+
 class BaseGeocodeData(object):
 
     def __init__(self):
@@ -39,7 +73,7 @@ class BaseGeocodeData(object):
         self.tree = self.load_tree(self.coordinates)
     
     def load_tree(self, coordinates):
-        return KDTree(coordinates)
+        return KDTree(unit_vectors(coordinates))
         
     def load_countries(self):
         raise NotImplementedError
@@ -47,22 +81,44 @@ class BaseGeocodeData(object):
     def extract(self):
         raise NotImplementedError
     
+    def bulk_query(self, coordinates, k=3, chunk_size=BULK_CHUNK_SIZE, n_jobs=1):
+        """Find the ``k`` nearest locations to each of N (lat, lon) pairs.
+
+        Returns two (N, k) arrays: the indices into ``self.locations``, and
+        the great-circle distances in kilometres. Coordinates are processed
+        ``chunk_size`` rows at a time to bound the temporary arrays.
+        """
+        coordinates = numpy.asarray(coordinates, dtype='f8').reshape(-1, 2)
+        k = min(k, self.tree.n)
+        count = len(coordinates)
+        indices = numpy.empty((count, k), dtype=numpy.intp)
+        distances = numpy.empty((count, k), dtype='f8')
+        for start in range(0, count, chunk_size):
+            end = start + chunk_size
+            chords, found = self.tree.query(
+                unit_vectors(coordinates[start:end]),
+                k=k,
+                n_jobs=n_jobs
+            )
+            indices[start:end] = found.reshape(-1, k)
+            distances[start:end] = chord_to_km(chords).reshape(-1, k)
+
+        return indices, distances
+
     def query(self, coordinates):
         """Find closest match to this list of coordinates
         """
         try:
-            distances, indices = self.tree.query(coordinates, k=3)
+            indices, distances = self.bulk_query(coordinates, k=3)
         except ValueError as e:
             raise ValueError('Unable to parse coordinates: {}'.format(coordinates))
 
-        #import ipdb; ipdb.set_trace()
-        #print '***', type(indices), indices, list(indices)
-        distances = distances.tolist()[0]
-        indices = indices.tolist()[0]
-        results = [self.locations[index] for index in indices]
-        for i, result in enumerate(results):
+        results = []
+        for index, distance in zip(indices[0].tolist(), distances[0].tolist()):
+            result = dict(self.locations[index])
             result['country'] = self.countries.get(result['co'], '')
-            result['distance'] = distances[i]
+            result['distance'] = distance
+            results.append(result)
         return results
 
     def get(self, coordinate):
@@ -77,17 +133,54 @@ class BaseGeocodeData(object):
 
 
 class TravelGeocodeData(BaseGeocodeData):
+    """Geocode data for travel entities that stays current without rebuilds.
 
-    def __init__(self, type_abbr=None):
+    Entities changed since the tree was built (by ``TravelEntity.updated``)
+    are picked up at most every ``refresh_seconds`` into a small delta buffer
+    that is searched by brute force alongside the tree, while the outdated
+    tree entries are masked out. Once the buffer grows past ``merge_size``,
+    or the masked entries past ``stale_size``, the tree is rebuilt in memory
+    from the current locations.
+
+    Each refresh re-reads the rows updated within ``REFRESH_OVERLAP`` of the
+    last one seen, and keeps only those whose values differ from what's
+    indexed, so rows committed late with an earlier timestamp aren't missed.
+    Writes that bypass ``save()`` must still set ``updated`` to be seen
+    after that window.
+
+    Deletions are only signalled within one process: entities deleted here
+    through the ORM are masked out immediately. Those deleted by another
+    process, or with raw SQL, are found on refresh, when the number of
+    located entities in the database no longer matches the index.
+    """
+
+    VALUES = ('id', 'code', 'name', 'lat', 'lon', 'type__abbr', 'country__code', 'updated')
+
+    REFRESH_OVERLAP = datetime.timedelta(minutes=5)
+
+    def __init__(self, type_abbr=None, refresh_seconds=60, merge_size=1000, stale_size=100):
         #type__abbr__in=['cn', 'lm']
-        values = ('code', 'name', 'lat', 'lon', 'type__abbr', 'country__code')
-        qs = TravelEntity.objects.filter(lat__isnull=False)
-        if type_abbr:
-            qs = qs.filter(type__abbr=type_abbr)
-        
-        self.entities = qs.values(*values)
+        self.type_abbr = type_abbr
+        self.refresh_seconds = refresh_seconds
+        self.merge_size = merge_size
+        self.stale_size = stale_size
+        self.entities = list(self.queryset().filter(
+            lat__isnull=False,
+            lon__isnull=False
+        ).values(*self.VALUES))
+        self.synced = max([e['updated'] for e in self.entities] or [None])
+        self.versions = dict((e['id'], self.version(e)) for e in self.entities)
+        self.checked = time.time()
         super(TravelGeocodeData, self).__init__()
-        
+        self.reset_delta()
+        _travel_geocoders.add(self)
+
+    def queryset(self):
+        qs = TravelEntity.objects.all()
+        if self.type_abbr:
+            qs = qs.filter(type__abbr=self.type_abbr)
+        return qs
+
     def load_countries(self):
         """Load a map of country code to name
         """
@@ -98,19 +191,152 @@ class TravelGeocodeData(BaseGeocodeData):
                 countries[e['code']] = e['name']
         return countries
 
+    def location(self, e):
+        return dict(
+            code=e['code'],
+            name=e['name'],
+            type=e['type__abbr'],
+            co=e['code'] if e['type__abbr'] == 'co' else e['country__code']
+        )
+
     def extract(self):
         coordinates, locations = [], []
         for e in self.entities:
             coordinates.append((e['lat'], e['lon']))
-            locations.append(dict(
-                code=e['code'],
-                name=e['name'],
-                type=e['type__abbr'],
-                co=e['country__code']
-            ))
-            
+            locations.append(self.location(e))
+
+        self.positions = dict((e['id'], i) for i, e in enumerate(self.entities))
         return coordinates, locations
 
+    def reset_delta(self):
+        self.tree_size = len(self.locations)
+        self.stale = set()
+        self.delta_ids = []
+        self.delta_coordinates = []
+        self.delta_vectors = numpy.empty((0, 3))
+
+    def version(self, e):
+        return tuple(e[key] for key in self.VALUES)
+
+    def forget(self, entity_id):
+        """Mask out an entity, wherever it currently lives
+        """
+        self.versions.pop(entity_id, None)
+        index = self.positions.pop(entity_id, None)
+        if index is not None:
+            self.stale.add(index)
+
+    def update(self, e):
+        """Add a new or changed entity to the delta buffer
+        """
+        self.forget(e['id'])
+        self.versions[e['id']] = self.version(e)
+        if e['lat'] is None or e['lon'] is None:
+            return
+
+        self.positions[e['id']] = len(self.locations)
+        self.locations.append(self.location(e))
+        self.delta_ids.append(e['id'])
+        self.delta_coordinates.append((e['lat'], e['lon']))
+
+    def refresh(self):
+        if time.time() - self.checked < self.refresh_seconds:
+            return
+
+        self.checked = time.time()
+        qs = self.queryset()
+        if self.synced:
+            qs = qs.filter(updated__gte=self.synced - self.REFRESH_OVERLAP)
+
+        rows = list(qs.order_by('updated').values(*self.VALUES))
+        changes = [e for e in rows if self.versions.get(e['id']) != self.version(e)]
+        for e in changes:
+            self.update(e)
+        if rows:
+            self.synced = max(self.synced, rows[-1]['updated']) if self.synced else rows[-1]['updated']
+
+        self.forget_deleted()
+        if changes:
+            self.delta_vectors = unit_vectors(self.delta_coordinates)
+
+    def forget_deleted(self):
+        """Mask out entities that have gone from the database without a
+        signal here, which only costs a count unless some have
+        """
+        located = self.queryset().filter(lat__isnull=False, lon__isnull=False)
+        if located.count() == len(self.positions):
+            return
+
+        for entity_id in set(self.positions) - set(located.values_list('id', flat=True)):
+            self.forget(entity_id)
+
+    def merge(self):
+        """Rebuild the tree from the live tree entries and the delta buffer
+        """
+        live = sorted(self.positions.items(), key=lambda item: item[1])
+        coordinates = numpy.concatenate((
+            numpy.asarray(self.coordinates, dtype='f8').reshape(-1, 2),
+            numpy.asarray(self.delta_coordinates, dtype='f8').reshape(-1, 2)
+        ))
+        keep = [index for entity_id, index in live]
+        self.coordinates = coordinates[keep]
+        self.locations = [self.locations[index] for index in keep]
+        self.positions = dict((entity_id, i) for i, (entity_id, index) in enumerate(live))
+        self.tree = self.load_tree(self.coordinates)
+        self.reset_delta()
+
+    def bulk_query(self, coordinates, k=3, chunk_size=BULK_CHUNK_SIZE, n_jobs=1):
+        self.refresh()
+        # masked entries are extra neighbours to ask the tree for in every query
+        if len(self.delta_ids) > self.merge_size or len(self.stale) > self.stale_size:
+            self.merge()
+
+        if not self.stale and not self.delta_ids:
+            return super(TravelGeocodeData, self).bulk_query(coordinates, k, chunk_size, n_jobs)
+
+        # keep the (rows x delta) distance matrix within ``chunk_size`` cells
+        coordinates = numpy.asarray(coordinates, dtype='f8').reshape(-1, 2)
+        step = max(1, chunk_size // max(1, len(self.delta_ids)))
+        indices, distances = [], []
+        for start in range(0, max(1, len(coordinates)), step):
+            found, km = self.query_with_delta(coordinates[start:start + step], k, n_jobs)
+            indices.append(found)
+            distances.append(km)
+
+        return numpy.vstack(indices), numpy.vstack(distances)
+
+    def query_with_delta(self, coordinates, k, n_jobs):
+        indices, distances = super(TravelGeocodeData, self).bulk_query(
+            coordinates,
+            k + len(self.stale),
+            n_jobs=n_jobs
+        )
+        if self.delta_ids:
+            offsets = unit_vectors(coordinates)[:, numpy.newaxis, :] - self.delta_vectors
+            chords = numpy.sqrt((offsets ** 2).sum(axis=2))
+            delta_indices = numpy.arange(self.tree_size, len(self.locations))
+            indices = numpy.hstack((indices, numpy.tile(delta_indices, (len(indices), 1))))
+            distances = numpy.hstack((distances, chord_to_km(chords)))
+
+        if self.stale:
+            distances[numpy.isin(indices, list(self.stale))] = numpy.inf
+
+        order = numpy.argsort(distances, axis=1)[:, :k]
+        rows = numpy.arange(len(indices))[:, numpy.newaxis]
+        return indices[rows, order], distances[rows, order]
+
+
+_travel_geocoders = weakref.WeakSet()
+
+
+def _entity_deleted(sender, instance, **kws):
+    for geocoder in _travel_geocoders:
+        geocoder.forget(instance.id)
+
+
+if TravelEntity:
+    post_delete.connect(_entity_deleted, sender=TravelEntity)
+
 
 class CSVGeocodeData(BaseGeocodeData):
 
@@ -122,12 +348,7 @@ class CSVGeocodeData(BaseGeocodeData):
         super(CSVGeocodeData, self).__init__()
   
     def load_countries(self):
-        """Load a map of country code to name
-        """
-        countries = {}
-        for code, name in csv.reader(open(self.country_filename)):
-            countries[code] = name
-        return countries
+        return load_country_names(self.country_filename)
 
     def extract(self):
         """Extract geocode data from zip
@@ -141,6 +362,87 @@ class CSVGeocodeData(BaseGeocodeData):
         return coordinates, locations
 
 
+def index_filenames(index_base):
+    """Return the coordinate, unit vector and record filenames for a
+    compiled index
+    """
+    return index_base + '.coords.npy', index_base + '.vectors.npy', index_base + '.records.npy'
+
+
+def has_geocode_index(index_base='geocode'):
+    return all(os.path.exists(fn) for fn in index_filenames(relative_path(index_base)))
+
+
+def default_geocode_data():
+    """The compiled index once ``compile_geocode_index`` has been run,
+    otherwise the CSV it's compiled from
+    """
+    return geo_loader('mapped' if has_geocode_index() else 'csv')
+
+
+def compile_geocode_index(geocode_filename='geocode.csv', index_base='geocode'):
+    """Compile the geocode CSV into a binary index for ``MappedGeocodeData``:
+    a float64 array of (lat, lon) pairs, their embedding as unit vectors,
+    and a parallel array of fixed width (country code, city) records.
+    """
+    coordinates, records = [], []
+    for latitude, longitude, country_code, city in csv.reader(open(relative_path(geocode_filename))):
+        coordinates.append((float(latitude), float(longitude)))
+        records.append((country_code, city))
+
+    width = max([len(city) for co, city in records] or [1])
+    coords_fn, vectors_fn, records_fn = index_filenames(relative_path(index_base))
+    coordinates = numpy.array(coordinates, dtype='f8').reshape(-1, 2)
+    numpy.save(coords_fn, coordinates)
+    numpy.save(vectors_fn, numpy.ascontiguousarray(unit_vectors(coordinates)))
+    numpy.save(records_fn, numpy.array(records, dtype=[('co', 'S2'), ('type', 'S{}'.format(width))]))
+    return len(records)
+
+
+class MappedLocations(object):
+    """Read-only sequence of location dicts over a memory-mapped record array
+    """
+
+    def __init__(self, records):
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        record = self.records[index]
+        return dict(co=record['co'], type=record['type'])
+
+
+class MappedGeocodeData(BaseGeocodeData):
+    """Geocode data read from an index built by ``compile_geocode_index``.
+
+    The arrays, the unit vectors included, are memory-mapped read-only, so
+    workers share the pages and nothing is parsed or embedded at startup.
+    The KD-tree is built over the mapped vectors without copying them; only
+    its node arrays are per process, built with the quicker sliding midpoint
+    rule.
+    """
+
+    def __init__(self, index_base='geocode', country_filename='countries.csv'):
+        self.index_base = relative_path(index_base)
+        self.country_filename = relative_path(country_filename)
+        super(MappedGeocodeData, self).__init__()
+
+    def load_countries(self):
+        return load_country_names(self.country_filename)
+
+    def load_tree(self, coordinates):
+        return KDTree(self.vectors, balanced_tree=False, copy_data=False)
+
+    def extract(self):
+        coords_fn, vectors_fn, records_fn = index_filenames(self.index_base)
+        coordinates = numpy.load(coords_fn, mmap_mode='r')
+        self.vectors = numpy.load(vectors_fn, mmap_mode='r')
+        records = numpy.load(records_fn, mmap_mode='r')
+        return coordinates, MappedLocations(records)
+
+
 def test():
     from datetime import datetime
     # test some coordinate lookups
@@ -148,19 +450,19 @@ def test():
     city2 = (31.76, 35.21)
     
     start = datetime.now()
-    gd = geo_loader('csv')
+    gd = default_geocode_data()
     print gd.get(city1)
     print datetime.now() - start
     print
 
     start = datetime.now()
-    gd = geo_loader('csv')
+    gd = default_geocode_data()
     print gd.search([city1, city2])
     print datetime.now() - start
     print
 
     start = datetime.now()
-    gd = geo_loader('csv')
+    gd = default_geocode_data()
     print gd.search([(50.839998, 5.693614)])
     print datetime.now() - start
     print
@@ -0,0 +1,109 @@
+'''
+A local background queue for ``TravelEntity.update_flag``, which downloads,
+resizes and writes flag images and is too slow to run inside a request.
+
+Jobs are keyed on the entity, so submitting a flag URL for an entity that
+already has one waiting replaces the waiting URL rather than adding a second
+job. Progress is recorded in ``TravelFlag.status``; a failed update of an
+entity without a flag of its own leaves no flag behind.
+
+Set ``TRAVEL_FLAG_QUEUE_ASYNC = False`` to run updates inline instead, when
+``submit`` raises the error of a failed update.
+'''
+import logging
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+#===============================================================================
+class FlagUpdateQueue(object):
+
+    #---------------------------------------------------------------------------
+    def __init__(self):
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    #---------------------------------------------------------------------------
+    def submit(self, entity, flag_url):
+        '''
+        Queue an update of ``entity``'s flag from ``flag_url``, returning the
+        ``TravelFlag`` that will hold the result, now marked pending.
+        '''
+        from travel.models import TravelFlag
+        run_async = getattr(settings, 'TRAVEL_FLAG_QUEUE_ASYNC', True)
+        with self.condition:
+            job = self.pending.get(entity.id)
+            if job:
+                flag = job[1]
+            elif entity.flag and not entity.flag.is_locked:
+                flag = entity.flag
+                flag.set_status(TravelFlag.Status.PENDING)
+            else:
+                # held aside until the update succeeds, when it replaces the
+                # entity's flag (if any)
+                flag = TravelFlag.objects.create(source=flag_url, status=TravelFlag.Status.PENDING)
+
+            if run_async:
+                self.pending[entity.id] = (flag_url, flag)
+                self.start()
+                self.condition.notify()
+                return flag
+
+        self.process(entity.id, flag_url, flag)
+        return flag
+
+    #---------------------------------------------------------------------------
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, name='travel-flag-queue')
+            self.thread.daemon = True
+            self.thread.start()
+
+    #---------------------------------------------------------------------------
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                entity_id, (flag_url, flag) = self.pending.popitem(last=False)
+
+            try:
+                self.process(entity_id, flag_url, flag)
+            except Exception:
+                # already logged and recorded; carry on with the next job
+                pass
+            finally:
+                connection.close()
+
+    #---------------------------------------------------------------------------
+    def process(self, entity_id, flag_url, flag):
+        from travel.models import TravelEntity
+        try:
+            entity = TravelEntity.objects.select_related('flag', 'type').get(id=entity_id)
+            entity.update_flag(flag_url, flag)
+        except Exception as why:
+            logger.exception('Flag update from %s failed', flag_url)
+            if TravelEntity.objects.filter(id=entity_id, flag=flag).exists():
+                flag.set_status(flag.Status.FAILED, str(why))
+            else:
+                # held aside for the update, and nothing refers to it
+                flag.delete()
+            raise
+
+    #---------------------------------------------------------------------------
+    def __len__(self):
+        with self.condition:
+            return len(self.pending)
+
+
+flag_queue = FlagUpdateQueue()
+
+
+#-------------------------------------------------------------------------------
+def submit(entity, flag_url):
+    return flag_queue.submit(entity, flag_url)
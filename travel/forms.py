@@ -1,8 +1,10 @@
 from datetime import datetime, date
 from django import forms
 from django.conf import settings
+from django.db import transaction
 from travel import models as travel
 from travel import utils as travel_utils
+from travel import flag_queue
 import pytz
 
 #-------------------------------------------------------------------------------
@@ -167,18 +169,31 @@ class BaseTravelEntityForm(forms.ModelForm):
     #---------------------------------------------------------------------------
     def save_flag(self, instance):
         flag_url = self.cleaned_data.get('flag_url', None)
-        if flag_url:
-            instance.update_flag(flag_url)
+        if flag_url and 'flag_url' in self.changed_data:
+            try:
+                flag_queue.submit(instance, flag_url)
+            except Exception as why:
+                # only raised when flag updates run inline
+                self.add_error('flag_url', 'The flag could not be updated: {}'.format(why))
         
     #---------------------------------------------------------------------------
-    def save(self, *args, **kws):
-        instance = super(BaseTravelEntityForm, self).save(*args, **kws)
+    def save(self, commit=True):
+        instance = super(BaseTravelEntityForm, self).save(commit=False)
         lat_lon = self.cleaned_data.get('lat_lon')
         if lat_lon:
             instance.lat, instance.lon = lat_lon
+
+        # the flag is submitted once the entity exists: with save_m2m, when
+        # saved with commit=False
+        save_m2m = self.save_m2m
+        def save_related():
+            save_m2m()
+            self.save_flag(instance)
+
+        self.save_m2m = save_related
+        if commit:
             instance.save()
-            
-        self.save_flag(instance)
+            self.save_m2m()
         return instance
 
 
@@ -203,8 +218,13 @@ class NewTravelEntityForm(BaseTravelEntityForm):
         for key, value in extra_fields.items():
             setattr(instance, key, value)
             
-        instance.save()
-        self.save_flag(instance)
+        with transaction.atomic():
+            instance.save()
+            self.save_m2m()
+            if self.errors:
+                # the flag failed to update inline; leave the form to be fixed
+                # rather than an entity added without it
+                transaction.set_rollback(True)
         return instance
 
 
@@ -0,0 +1,458 @@
+'''
+Cached, paginated snapshots of the ``by_locale`` entity listings, and
+keyset pagination of those snapshots and of arbitrary entity querysets, for
+the HTML listings and for JSON streaming alike.
+
+Each snapshot row is a ``ListingRow``: a dict holding only the values the
+``entities/listing/*.html`` templates use, in the same shape as the model
+attributes they reference (``place.country.flag.thumb.url`` and so on), so
+the templates render rows and model instances alike.
+
+Invalidating a listing bumps its generation rather than dropping the
+snapshot: the outdated snapshot keeps being served while a background thread
+builds its replacement. Only a listing with no snapshot at all is built on
+the request. Set ``TRAVEL_LISTING_REBUILD_ASYNC = False`` to rebuild inline.
+'''
+import json
+import base64
+import bisect
+import operator
+import logging
+import threading
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+from django.core.files.storage import default_storage
+from django.core.urlresolvers import reverse
+from django.utils.encoding import python_2_unicode_compatible
+
+LISTING_PAGE_SIZE = 500
+KEYSET_BATCH_SIZE = 500
+KEYSET_PAGE_SIZE = 100
+LISTING_CACHE_KEY = 'travel:listing:{}'
+LISTING_TIMEOUT = 60 * 60 * 24
+LISTING_REBUILD_TIMEOUT = 60 * 5
+LISTING_TYPES = ('cn', 'co', 'st', 'ct', 'ap', 'np', 'lm', 'wh')
+
+# The listings whose rows show an entity of each type: its own, plus those
+# that show it as their continent, country, state or capital
+LISTING_DEPENDENTS = {
+    'cn': LISTING_TYPES,
+    'co': LISTING_TYPES,
+    'st': ('st', 'ct', 'ap', 'np', 'lm', 'wh'),
+    'ct': ('ct', 'co', 'st'),
+}
+
+LISTING_VALUES = (
+    'id', 'code', 'name', 'full_name', 'locality', 'category',
+    'type__abbr', 'type__title', 'flag__thumb', 'flag__is_locked',
+    'country__code', 'country__name', 'country__flag__thumb',
+    'state__code', 'state__name', 'state__flag__thumb',
+    'capital__id', 'capital__code', 'capital__name', 'capital__type__abbr',
+    'continent__name', 'entityinfo__population', 'entityinfo__area',
+)
+
+ENTITY_JSON_VALUES = (
+    'id', 'code', 'name', 'full_name', 'locality', 'lat', 'lon',
+    'type__abbr', 'country__code',
+)
+
+
+#===============================================================================
+@python_2_unicode_compatible
+class ListingRow(dict):
+
+    #---------------------------------------------------------------------------
+    def __str__(self):
+        return self.get('name') or ''
+
+
+#-------------------------------------------------------------------------------
+def _flag(thumb, is_locked=False):
+    if not thumb:
+        return None
+    return ListingRow(thumb={'url': default_storage.url(thumb)}, is_locked=is_locked)
+
+
+#-------------------------------------------------------------------------------
+def entity_url(abbr, code, country_code=None):
+    if abbr in ('st', 'wh') and country_code:
+        code = '{}-{}'.format(country_code, code)
+    return reverse('travel-entity', args=[abbr, code])
+
+
+#-------------------------------------------------------------------------------
+def listing_row(values):
+    from travel.models import category_detail
+    abbr, country_code = values['type__abbr'], values['country__code']
+    row = ListingRow(
+        id=values['id'],
+        code=values['code'],
+        name=values['name'],
+        full_name=values['full_name'],
+        locality=values['locality'],
+        category_detail=category_detail(abbr, values['category'], values['type__title']),
+        get_absolute_url=entity_url(abbr, values['code'] or values['id'], country_code),
+        flag=_flag(values['flag__thumb'], values['flag__is_locked']),
+        country=None,
+        state=None,
+        capital=None,
+        continent=values['continent__name'],
+        entityinfo=None,
+    )
+    if country_code:
+        row['country'] = ListingRow(
+            name=values['country__name'],
+            get_absolute_url=entity_url('co', country_code),
+            flag=_flag(values['country__flag__thumb'])
+        )
+    if values['state__code']:
+        row['state'] = ListingRow(
+            name=values['state__name'],
+            get_absolute_url=entity_url('st', values['state__code'], country_code),
+            flag=_flag(values['state__flag__thumb'])
+        )
+    if values['capital__id']:
+        row['capital'] = ListingRow(
+            name=values['capital__name'],
+            get_absolute_url=entity_url(
+                values['capital__type__abbr'],
+                values['capital__code'] or values['capital__id'],
+                country_code
+            )
+        )
+    if values['entityinfo__population'] or values['entityinfo__area']:
+        row['entityinfo'] = {
+            'population': values['entityinfo__population'],
+            'area': values['entityinfo__area']
+        }
+    return row
+
+
+logger = logging.getLogger(__name__)
+
+
+#-------------------------------------------------------------------------------
+def _generation(abbr):
+    return cache.get(LISTING_CACHE_KEY.format(abbr) + ':generation') or 0
+
+
+#-------------------------------------------------------------------------------
+def _page_key(abbr, version, page):
+    return '{}:{}:{}'.format(LISTING_CACHE_KEY.format(abbr), version, page)
+
+
+#-------------------------------------------------------------------------------
+def _row_key(row):
+    return (row['name'], row['id'])
+
+
+#-------------------------------------------------------------------------------
+def build_listing(abbr, page_size=LISTING_PAGE_SIZE):
+    '''
+    Snapshot every entity of type ``abbr`` into cached pages of
+    ``page_size`` rows, returning the snapshot's metadata. Snapshots expire
+    after ``LISTING_TIMEOUT``, so the pages of replaced versions don't pile up.
+    '''
+    from travel.models import TravelEntity
+    version = cache.get(LISTING_CACHE_KEY.format(abbr) + ':version') or 0
+    version += 1
+
+    # read first, so that changes made while building still outdate it
+    generation = _generation(abbr)
+
+    qs = TravelEntity.objects.filter(type__abbr=abbr)
+    rows = [listing_row(values) for values in qs.values(*LISTING_VALUES).iterator()]
+
+    # sorted here rather than by the database, so that the rows are in the
+    # order their keyset cursors compare in, whatever the database collation
+    rows.sort(key=_row_key)
+    pages = dict(
+        (_page_key(abbr, version, number), rows[start:start + page_size])
+        for number, start in enumerate(range(0, len(rows), page_size))
+    )
+
+    meta = {
+        'version': version,
+        'count': len(rows),
+        'page_size': page_size,
+        'generation': generation,
+        'starts': [_row_key(row) for row in rows[::page_size]],
+    }
+    cache.set_many(pages, LISTING_TIMEOUT)
+    cache.set(LISTING_CACHE_KEY.format(abbr) + ':version', version, None)
+    cache.set(LISTING_CACHE_KEY.format(abbr), meta, LISTING_TIMEOUT)
+    return meta
+
+
+#-------------------------------------------------------------------------------
+def _rebuild_listing(abbr, lock):
+    try:
+        build_listing(abbr)
+    except Exception:
+        logger.exception('Rebuilding the %s listing failed', abbr)
+    finally:
+        cache.delete(lock)
+        connection.close()
+
+
+#-------------------------------------------------------------------------------
+def schedule_rebuild(abbr):
+    '''
+    Rebuild ``abbr``'s snapshot in a background thread, unless some process
+    is already doing so. Returns the new snapshot's metadata when rebuilt
+    inline instead.
+    '''
+    lock = LISTING_CACHE_KEY.format(abbr) + ':rebuilding'
+    if not cache.add(lock, True, LISTING_REBUILD_TIMEOUT):
+        return None
+
+    if not getattr(settings, 'TRAVEL_LISTING_REBUILD_ASYNC', True):
+        try:
+            return build_listing(abbr)
+        finally:
+            cache.delete(lock)
+
+    thread = threading.Thread(target=_rebuild_listing, args=(abbr, lock), name='travel-listing-' + abbr)
+    thread.daemon = True
+    thread.start()
+    return None
+
+
+#-------------------------------------------------------------------------------
+def invalidate_listing(*abbrs):
+    '''
+    Mark the snapshots showing entities of the types ``abbrs`` as outdated.
+    '''
+    keys = set()
+    for abbr in abbrs:
+        keys.update(LISTING_DEPENDENTS.get(abbr, (abbr,)))
+
+    for key in keys:
+        key = LISTING_CACHE_KEY.format(key) + ':generation'
+        try:
+            cache.incr(key)
+        except ValueError:
+            if not cache.add(key, 1, None):
+                cache.incr(key)
+
+
+#===============================================================================
+class EntityListing(object):
+    '''
+    Sequence over a type's listing snapshot that loads only the cached pages
+    a slice touches, and that ``after`` seeks into by keyset cursor.
+    '''
+
+    #---------------------------------------------------------------------------
+    def __init__(self, abbr):
+        self.abbr = abbr
+        self.meta = cache.get(LISTING_CACHE_KEY.format(abbr))
+        if self.meta is None or 'starts' not in self.meta:
+            self.meta = build_listing(abbr)
+        elif self.meta.get('generation') != _generation(abbr):
+            # an asynchronous rebuild leaves this one to be served meanwhile
+            self.meta = schedule_rebuild(abbr) or self.meta
+
+    #---------------------------------------------------------------------------
+    def __len__(self):
+        return self.meta['count']
+
+    #---------------------------------------------------------------------------
+    def count(self):
+        return len(self)
+
+    #---------------------------------------------------------------------------
+    def page(self, number):
+        rows = cache.get(_page_key(self.abbr, self.meta['version'], number))
+        if rows is None:
+            # evicted; rebuild the whole snapshot so the pages stay consistent
+            self.meta = build_listing(self.abbr)
+            rows = cache.get(_page_key(self.abbr, self.meta['version'], number)) or []
+        return rows
+
+    #---------------------------------------------------------------------------
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            rows = self[index:index + 1]
+            if not rows:
+                raise IndexError(index)
+            return rows[0]
+
+        start, stop, step = index.indices(len(self))
+        if start >= stop:
+            return []
+
+        size = self.meta['page_size']
+        rows = []
+        for number in range(start // size, (stop - 1) // size + 1):
+            rows.extend(self.page(number))
+        offset = (start // size) * size
+        return rows[start - offset:stop - offset:step]
+
+    #---------------------------------------------------------------------------
+    def __iter__(self):
+        size = self.meta['page_size']
+        for number in range(0, (len(self) + size - 1) // size):
+            for row in self.page(number):
+                yield row
+
+    #---------------------------------------------------------------------------
+    def after(self, key=None, limit=KEYSET_PAGE_SIZE):
+        '''
+        Up to ``limit`` rows following the ``(name, id)`` pair ``key``, found
+        by bisecting the first keys of the pages and then the one page
+        ``key`` falls in.
+        '''
+        start = 0
+        if key is not None:
+            key = tuple(key)
+            if len(key) != 2:
+                raise ValueError('Expected a (name, id) cursor')
+            number = max(bisect.bisect_right(self.meta['starts'], key) - 1, 0)
+            keys = [_row_key(row) for row in self.page(number)]
+            start = number * self.meta['page_size'] + bisect.bisect_right(keys, key)
+        return self[start:start + limit]
+
+
+#-------------------------------------------------------------------------------
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+#-------------------------------------------------------------------------------
+def decode_cursor(cursor, size=None):
+    '''
+    The values encoded in ``cursor``, the last of which is an id. Raises
+    ``ValueError`` for anything else, or for other than ``size`` values.
+    '''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        values = tuple(values[:-1]) + (int(values[-1]),)
+    except (TypeError, ValueError, IndexError, KeyError):
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+
+    if size is not None and len(values) != size:
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+    return values
+
+
+#-------------------------------------------------------------------------------
+def keyset_ordering(qs):
+    '''
+    The fields ``qs`` is ordered by, ending with ``id`` so that every row's
+    key is unique. Descending fields keep their ``-`` prefix.
+    '''
+    ordering = [
+        'id' if field == 'pk' else '-id' if field == '-pk' else field
+        for field in (qs.query.order_by or qs.model._meta.ordering)
+    ]
+    if not set(['id', '-id']) & set(ordering):
+        ordering.append('id')
+    return tuple(ordering)
+
+
+#-------------------------------------------------------------------------------
+def keyset_q(ordering, after):
+    '''
+    Filter for the rows following the one whose values of the ``ordering``
+    fields are ``after``.
+    '''
+    if len(after) != len(ordering):
+        raise ValueError('Expected a cursor of {} values'.format(len(ordering)))
+
+    qq, equal = [], {}
+    for field, value in zip(ordering, after):
+        name = field.lstrip('-')
+        lookup = '__lt' if field.startswith('-') else '__gt'
+        qq.append(Q(**dict(equal, **{name + lookup: value})))
+        equal[name] = value
+    return reduce(operator.or_, qq)
+
+
+#-------------------------------------------------------------------------------
+def keyset_batches(qs, after=None, limit=None, batch_size=KEYSET_BATCH_SIZE):
+    '''
+    Yield lists of entity value dicts in ``(name, id)`` order, starting after
+    the ``(name, id)`` pair ``after``. Each batch is its own query seeking
+    past the last row of the previous one, so no query uses an OFFSET and
+    only one batch is held in memory.
+    '''
+    ordering = ('name', 'id')
+    qs = qs.order_by(*ordering).values(*ENTITY_JSON_VALUES)
+    while limit is None or limit > 0:
+        page = qs.filter(keyset_q(ordering, after)) if after else qs
+        size = batch_size if limit is None else min(batch_size, limit)
+        rows = list(page[:size])
+        if not rows:
+            break
+
+        yield rows
+        if len(rows) < size:
+            break
+
+        after = (rows[-1]['name'], rows[-1]['id'])
+        if limit is not None:
+            limit -= len(rows)
+
+
+#-------------------------------------------------------------------------------
+def keyset_page(places, after=None, size=KEYSET_PAGE_SIZE):
+    '''
+    Up to ``size`` of ``places``, an ``EntityListing`` or a queryset, following
+    the cursor ``after``; and the cursor of the next page, or ``None`` if this
+    is the last. One extra row is read to tell whether another page follows.
+    '''
+    if isinstance(places, EntityListing):
+        rows = places.after(after, size + 1)
+        key = _row_key
+    else:
+        ordering = keyset_ordering(places)
+        qs = places.order_by(*ordering)
+        rows = list((qs.filter(keyset_q(ordering, after)) if after else qs)[:size + 1])
+        key = lambda obj: tuple(getattr(obj, field.lstrip('-')) for field in ordering)
+
+    if len(rows) <= size:
+        return rows, None
+    return rows[:size], encode_cursor(*key(rows[size - 1]))
+
+
+#-------------------------------------------------------------------------------
+def entity_json(values):
+    abbr = values['type__abbr']
+    return {
+        'id': values['id'],
+        'type': abbr,
+        'code': values['code'],
+        'name': values['name'],
+        'full_name': values['full_name'],
+        'locality': values['locality'],
+        'country': values['country__code'],
+        'lat': str(values['lat']) if values['lat'] is not None else None,
+        'lon': str(values['lon']) if values['lon'] is not None else None,
+        'url': entity_url(abbr, values['code'] or values['id'], values['country__code']),
+    }
+
+
+#-------------------------------------------------------------------------------
+def stream_entities_json(qs, after=None, limit=None):
+    '''
+    Generate a JSON document of the form ``{"results": [...], "next": cursor}``
+    chunk by chunk. ``next`` is ``null`` once the results are exhausted.
+    '''
+    yield '{"results": ['
+    last, count, more = None, 0, False
+    for rows in keyset_batches(qs, after, None if limit is None else limit + 1):
+        if limit is not None and count + len(rows) > limit:
+            # the extra row was read only to tell whether more follow
+            rows, more = rows[:limit - count], True
+
+        if rows:
+            chunk = ', '.join(json.dumps(entity_json(row)) for row in rows)
+            yield (', ' if count else '') + chunk
+            count += len(rows)
+            last = rows[-1]
+
+    cursor = encode_cursor(last['name'], last['id']) if more else None
+    yield '], "next": {}}}'.format(json.dumps(cursor))
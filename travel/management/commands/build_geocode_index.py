@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from travel.extras.geocode import reversegc
+
+#===============================================================================
+class Command(BaseCommand):
+    help = 'Compile geocode.csv into the memory-mapped reverse geocoder index'
+
+    #---------------------------------------------------------------------------
+    def add_arguments(self, parser):
+        parser.add_argument('--geocode', default='geocode.csv')
+        parser.add_argument('--index', default='geocode')
+
+    #---------------------------------------------------------------------------
+    def handle(self, *args, **options):
+        count = reversegc.compile_geocode_index(options['geocode'], options['index'])
+        self.stdout.write('Compiled {} locations'.format(count))
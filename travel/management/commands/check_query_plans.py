@@ -0,0 +1,104 @@
+import re
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from travel.models import TravelEntity, TravelLog, TravelLogSummary
+
+# Plan lines showing a full read of a table, an index lookup on a column, or
+# a sort the index should have made unnecessary, per database vendor
+SCAN_PATTERNS = {
+    'sqlite': r'\bSCAN (TABLE )?{table}\b',
+    'postgresql': r'\bSeq Scan on {table}\b',
+}
+
+KEY_PATTERNS = {
+    'sqlite': r'\b{column}=\?',
+    'postgresql': r'\b{column} = ',
+}
+
+SORT_PATTERNS = {
+    'sqlite': r'\bUSE TEMP B-TREE FOR ORDER BY\b',
+    'postgresql': r'\bSort\b',
+}
+
+
+#-------------------------------------------------------------------------------
+def hot_queries():
+    '''
+    ``(name, queryset, table, columns, ordered)`` for the queries that have to
+    look up ``table`` through an index on all of ``columns``, built the same
+    way the views build them. ``ordered`` queries should also be read in index
+    order, without a sort.
+    '''
+    user = User(id=1)
+    entity = TravelEntity(id=1)
+    entities, logs = TravelLog.user_history(user)
+    log_table = TravelLog._meta.db_table
+    summary_table = TravelLogSummary._meta.db_table
+    return (
+        ('entity page logs', user.travellog_set.filter(entity=entity),
+            log_table, ('user_id', 'entity_id'), True),
+        ('log summary refresh', TravelLog.objects.filter(user=user, entity=entity).order_by(),
+            log_table, ('user_id', 'entity_id'), False),
+        ('history logs', logs, log_table, ('user_id',), True),
+        ('history entities', entities, log_table, ('user_id',), False),
+        ('bucket list results', user.travel_summaries.filter(entity__in=[entity]),
+            summary_table, ('user_id', 'entity_id'), False),
+    )
+
+
+#===============================================================================
+class Command(BaseCommand):
+    help = 'EXPLAIN the hot TravelLog queries and fail if any has to scan its table'
+
+    #---------------------------------------------------------------------------
+    def add_arguments(self, parser):
+        parser.add_argument('--show', action='store_true', help='Print each query plan')
+
+    #---------------------------------------------------------------------------
+    def explain(self, cursor, qs):
+        sql, params = qs.query.sql_with_params()
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return '\n'.join(row[-1] for row in cursor.fetchall())
+
+        cursor.execute('EXPLAIN ' + sql, params)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+    #---------------------------------------------------------------------------
+    def handle(self, *args, **options):
+        vendor = connection.vendor
+        if vendor not in SCAN_PATTERNS:
+            raise CommandError('Query plans can only be checked on {}'.format(
+                ' or '.join(sorted(SCAN_PATTERNS))
+            ))
+
+        failures = []
+        with connection.cursor() as cursor:
+            if vendor == 'postgresql':
+                # small tables are cheapest to scan, so rule that out to see
+                # whether an index could be used at all
+                cursor.execute('SET enable_seqscan = off')
+
+            for name, qs, table, columns, ordered in hot_queries():
+                plan = self.explain(cursor, qs)
+                problems = []
+                if re.search(SCAN_PATTERNS[vendor].format(table=re.escape(table)), plan):
+                    problems.append('scans {}'.format(table))
+                for column in columns:
+                    if not re.search(KEY_PATTERNS[vendor].format(column=column), plan):
+                        problems.append('no index on {}'.format(column))
+                if ordered and re.search(SORT_PATTERNS[vendor], plan):
+                    problems.append('sorts its results')
+
+                self.stdout.write('{:<24} {}'.format(name, ', '.join(problems) or 'ok'))
+                if options['show'] or problems:
+                    self.stdout.write('    ' + plan.replace('\n', '\n    '))
+                if problems:
+                    failures.append(name)
+
+            if vendor == 'postgresql':
+                cursor.execute('RESET enable_seqscan')
+
+        if failures:
+            raise CommandError('Unindexed queries: {}'.format(', '.join(failures)))
@@ -1,5 +1,5 @@
 from django.core.management.base import BaseCommand, CommandError
-from travel.geocode import reversegc
+from travel.extras.geocode import reversegc
 from pprint import pprint
 
 #===============================================================================
@@ -13,7 +13,7 @@ class Command(BaseCommand):
             args = args[1:]
         else:
             kind = None
-        gd = reversegc.geo_loader('csv') #, kind)
+        gd = reversegc.default_geocode_data()
         for arg in args:
             coords = tuple([float(f) for f in arg.split(',')])
             pprint(gd.get(coords))
@@ -0,0 +1,228 @@
+import os
+import codecs
+import hashlib
+import multiprocessing
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from travel import utils as travel_utils
+from travel import listing as travel_listing
+from travel.models import TravelEntity, TravelFlag
+from travel.extras.flag_game import invalidate_flag_game_data
+
+# returned for a source the server says hasn't changed
+NOT_MODIFIED = object()
+
+
+#-------------------------------------------------------------------------------
+def read_manifest(filename, delimiter='|'):
+    '''
+    Lines of ``type|code|flag_url``, where ``code`` may be ``country-code``
+    for states and World Heritage sites, as in entity URLs.
+    '''
+    items = []
+    with codecs.open(filename, encoding='utf-8') as fp:
+        for lineno, line in enumerate(fp, 1):
+            line = line.strip()
+            if line and not line.startswith('#'):
+                items.append((lineno, line.split(delimiter)))
+    return items
+
+
+#-------------------------------------------------------------------------------
+def manifest_key(fields):
+    # progress is recorded by line content, so it survives edits to the manifest
+    return u'|'.join(fields)
+
+
+#-------------------------------------------------------------------------------
+def resize_flag_image(data):
+    # module level, for the process pool
+    try:
+        return travel_utils.resize_flag_image(data)
+    except Exception:
+        return None
+
+
+#===============================================================================
+class Command(BaseCommand):
+    help = 'Import flags in bulk from a manifest of "type|code|flag_url" lines'
+
+    #---------------------------------------------------------------------------
+    def add_arguments(self, parser):
+        parser.add_argument('manifest')
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent downloads')
+        parser.add_argument('--processes', type=int, default=None, help='Resizing processes')
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--progress', default=None,
+            help='File recording the type|code|url lines done, for resuming; defaults to <manifest>.progress')
+        parser.add_argument('--restart', action='store_true', help='Ignore previous progress')
+        parser.add_argument('--force', action='store_true',
+            help='Download and import even sources that are unchanged')
+
+    #---------------------------------------------------------------------------
+    def handle(self, *args, **options):
+        manifest = options['manifest']
+        if not os.path.exists(manifest):
+            raise CommandError('No such manifest: {}'.format(manifest))
+
+        progress = options['progress'] or manifest + '.progress'
+        done = set()
+        if os.path.exists(progress) and not options['restart']:
+            with codecs.open(progress, encoding='utf-8') as fp:
+                done = set(line.strip() for line in fp if line.strip())
+
+        items = [item for item in read_manifest(manifest) if manifest_key(item[1]) not in done]
+        self.stdout.write('{} flags to import, {} already done'.format(len(items), len(done)))
+
+        self.force = options['force']
+        self.fetcher = travel_utils.UrlFetcher(workers=options['workers'])
+        self.pool = multiprocessing.Pool(options['processes'])
+        self.counts = dict.fromkeys(('imported', 'unchanged', 'failed'), 0)
+        size = options['batch_size']
+        try:
+            with codecs.open(progress, 'w' if options['restart'] else 'a', encoding='utf-8') as fp:
+                for start in range(0, len(items), size):
+                    # failed lines aren't recorded, so a resumed run retries them
+                    done = self.import_batch(items[start:start + size])
+                    fp.write(u''.join(u'{}\n'.format(key) for key in done))
+                    fp.flush()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+        self.stdout.write('Imported {imported}, unchanged {unchanged}, failed {failed}'.format(**self.counts))
+
+    #---------------------------------------------------------------------------
+    def fail(self, lineno, message):
+        self.counts['failed'] += 1
+        self.stderr.write('Line {}: {}'.format(lineno, message))
+
+    #---------------------------------------------------------------------------
+    def fetch(self, url):
+        try:
+            return self.fetcher.get(url)
+        except requests.RequestException:
+            return None
+
+    #---------------------------------------------------------------------------
+    def fetch_source(self, job):
+        '''
+        ``(data, etag, last_modified)`` for the source of a job's flag;
+        ``NOT_MODIFIED`` when the server says the source stored from the
+        same URL is unchanged, or ``None`` if it can't be downloaded.
+        '''
+        lineno, entity, url = job
+        flag, headers = entity.flag, {}
+        if not self.force and flag and flag.source == url:
+            if flag.etag:
+                headers['If-None-Match'] = flag.etag
+            if flag.last_modified:
+                headers['If-Modified-Since'] = flag.last_modified
+
+        try:
+            r = self.fetcher.get_response(url, headers)
+        except requests.RequestException:
+            return None
+
+        if r.status_code == 304 and headers:
+            return NOT_MODIFIED
+        if not r.ok:
+            return None
+        return r.content, r.headers.get('ETag', ''), r.headers.get('Last-Modified', '')
+
+    #---------------------------------------------------------------------------
+    def resolve(self, batch):
+        jobs = []
+        for lineno, fields in batch:
+            if len(fields) != 3:
+                self.fail(lineno, 'Expected type|code|flag_url')
+                continue
+
+            ref, code, url = fields
+            code, _, aux = code.partition('-')
+            entities = list(TravelEntity.objects.find(ref, code, aux).select_related(
+                'type', 'country', 'flag'
+            )[:2])
+            if len(entities) != 1:
+                self.fail(lineno, 'No single entity {}/{}'.format(ref, fields[1]))
+            elif entities[0].flag and entities[0].flag.is_locked:
+                self.fail(lineno, 'Flag of {} is locked'.format(entities[0]))
+            else:
+                jobs.append((lineno, entities[0], url))
+        return jobs
+
+    #---------------------------------------------------------------------------
+    def import_batch(self, batch):
+        '''
+        Import the flags of ``batch``, returning the ``manifest_key`` of the
+        lines imported or found unchanged.
+        '''
+        # download the changed sources only: conditionally, where the server
+        # gave validators, and otherwise by comparing checksums
+        keys = dict((lineno, manifest_key(fields)) for lineno, fields in batch)
+        changed, done = [], []
+        jobs = self.resolve(batch)
+        sources = self.fetcher.map(self.fetch_source, jobs)
+        for (lineno, entity, url), source in zip(jobs, sources):
+            if source is None:
+                self.fail(lineno, 'Unable to download {}'.format(url))
+                continue
+            elif source is NOT_MODIFIED:
+                self.counts['unchanged'] += 1
+                done.append(keys[lineno])
+                continue
+
+            data, etag, last_modified = source
+            checksum = hashlib.sha1(data).hexdigest()
+            flag = entity.flag
+            if not self.force and flag and flag.source == url and flag.checksum == checksum:
+                # keep the validators, for a conditional request next time
+                TravelFlag.objects.filter(id=flag.id).update(etag=etag, last_modified=last_modified)
+                self.counts['unchanged'] += 1
+                done.append(keys[lineno])
+            else:
+                changed.append((lineno, entity, url, data, checksum, etag, last_modified))
+
+        # SVG flags come with prerendered thumbnails; anything else is resized
+        svgs = [job for job in changed if travel_utils.is_svg_url(job[2])]
+        rasters = [job for job in changed if not travel_utils.is_svg_url(job[2])]
+        thumbnails = self.fetcher.map(self.fetch, [
+            thumb_url for job in svgs for thumb_url in travel_utils.wiki_thumbnail_urls(job[2])
+        ])
+        sizes = len(travel_utils.DEFAULT_FLAG_SIZES)
+        images = []
+        for i, job in enumerate(svgs):
+            image = [job[3]] + thumbnails[i * sizes:(i + 1) * sizes]
+            images.append(image if all(image) else None)
+
+        for job, resized in zip(rasters, self.pool.map(resize_flag_image, [job[3] for job in rasters])):
+            images.append([None] + resized if resized else None)
+
+        types = set()
+        with transaction.atomic():
+            for (lineno, entity, url, data, checksum, etag, last_modified), image in zip(svgs + rasters, images):
+                if not image:
+                    self.fail(lineno, 'Unable to read image {}'.format(url))
+                    continue
+
+                flag = entity.flag or TravelFlag()
+                flag.store(
+                    url, entity.flag_dir, entity.code, *image,
+                    checksum=checksum, etag=etag, last_modified=last_modified
+                )
+                flag.save()
+                if entity.flag_id != flag.id:
+                    TravelEntity.objects.filter(id=entity.id).update(flag=flag)
+
+                types.add(entity.type.abbr)
+                self.counts['imported'] += 1
+                done.append(keys[lineno])
+
+        for abbr in types:
+            travel_listing.invalidate_listing(abbr)
+
+        if types:
+            invalidate_flag_game_data()
+
+        return done
@@ -0,0 +1,162 @@
+import io
+import os
+import time
+from decimal import Decimal
+from itertools import islice
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from travel import utils as travel_utils
+from travel import listing as travel_listing
+from travel.models import TravelEntity, TravelEntityType, TravelSearchToken
+from travel.search import SEARCH_FIELDS
+
+# Columns of the GeoNames dump files (cities1000.txt, allCountries.txt, ...)
+GEONAMEID, NAME, LATITUDE, LONGITUDE = 0, 1, 4, 5
+FEATURE_CLASS, COUNTRY_CODE, ADMIN1_CODE, TIMEZONE = 6, 8, 10, 17
+
+# The fields compared to decide whether an existing entity needs updating
+UPDATE_FIELDS = ('name', 'lat', 'lon', 'country_id', 'state_id', 'tz', 'geocell')
+
+COORDINATE = Decimal('0.0001')
+
+
+#-------------------------------------------------------------------------------
+def read_geonames(filename, skip=0):
+    '''
+    Yield ``(lineno, columns)`` for each row of a tab-delimited GeoNames dump,
+    after the first ``skip`` lines.
+    '''
+    with io.open(filename, encoding='utf-8') as fp:
+        for lineno, line in enumerate(islice(fp, skip, None), skip + 1):
+            line = line.rstrip('\n')
+            if line and not line.startswith('#'):
+                yield lineno, line.split('\t')
+
+
+#===============================================================================
+class Command(BaseCommand):
+    help = 'Create or update entities, keyed on geonameid, from a GeoNames dump such as cities1000.txt'
+
+    #---------------------------------------------------------------------------
+    def add_arguments(self, parser):
+        parser.add_argument('filename')
+        parser.add_argument('--type', default='ct', help='Entity type of the imported places')
+        parser.add_argument('--feature-class', default='P', help='Only rows of this GeoNames feature class')
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--progress', default=None,
+            help='File recording the last line imported, for resuming; defaults to <filename>.progress')
+        parser.add_argument('--restart', action='store_true', help='Ignore previous progress')
+
+    #---------------------------------------------------------------------------
+    def handle(self, *args, **options):
+        filename = options['filename']
+        if not os.path.exists(filename):
+            raise CommandError('No such file: {}'.format(filename))
+
+        try:
+            self.type = TravelEntityType.objects.get(abbr=options['type'])
+        except TravelEntityType.DoesNotExist:
+            raise CommandError('Unknown entity type: {}'.format(options['type']))
+
+        progress = options['progress'] or filename + '.progress'
+        skip = 0
+        if os.path.exists(progress) and not options['restart']:
+            with open(progress) as fp:
+                skip = int(fp.read().strip() or 0)
+            self.stdout.write('Resuming after line {}'.format(skip))
+
+        # parents resolved in memory: countries by code, states by (country, code)
+        self.countries = dict(TravelEntity.objects.filter(type__abbr='co').values_list('code', 'id'))
+        self.states = dict(
+            ((country, code), pk) for pk, country, code in
+            TravelEntity.objects.filter(type__abbr='st').values_list('id', 'country__code', 'code')
+        )
+        self.parents = set()
+        self.counts = dict.fromkeys(('created', 'updated', 'unchanged'), 0)
+
+        feature_class = options['feature_class']
+        rows = read_geonames(filename, skip)
+        start, total = time.time(), 0
+        while True:
+            chunk = list(islice(rows, options['chunk_size']))
+            if not chunk:
+                break
+
+            lineno = chunk[-1][0]
+            chunk = [cols for _, cols in chunk if cols[FEATURE_CLASS] == feature_class]
+            with transaction.atomic():
+                changed = self.import_chunk(chunk)
+
+            # updated rows bypass save(), and with it the timezone signal
+            TravelEntity.objects.invalidate_timezones(changed)
+
+            with open(progress, 'w') as fp:
+                fp.write('{}\n'.format(lineno))
+
+            total += len(chunk)
+            elapsed = time.time() - start
+            self.stdout.write('Line {}: {} rows, {:.0f} rows/sec'.format(
+                lineno, total, total / elapsed if elapsed else 0
+            ))
+
+        travel_listing.invalidate_listing(self.type.abbr)
+
+        # continents relate to entities through their country's continent as well
+        self.parents.update(TravelEntity.objects.filter(
+            id__in=self.parents
+        ).values_list('continent', flat=True))
+        self.parents.discard(None)
+        TravelEntity.objects.invalidate_relationships(self.parents)
+        self.stdout.write('Created {created}, updated {updated}, unchanged {unchanged}'.format(**self.counts))
+
+    #---------------------------------------------------------------------------
+    def entity_values(self, cols):
+        country = cols[COUNTRY_CODE]
+        lat = Decimal(cols[LATITUDE]).quantize(COORDINATE)
+        lon = Decimal(cols[LONGITUDE]).quantize(COORDINATE)
+        return {
+            'name': cols[NAME][:175],
+            'lat': lat,
+            'lon': lon,
+            'country_id': self.countries.get(country),
+            'state_id': self.states.get((country, cols[ADMIN1_CODE])),
+            'tz': cols[TIMEZONE][:40],
+            'geocell': travel_utils.geocell(lat, lon),
+        }
+
+    #---------------------------------------------------------------------------
+    def import_chunk(self, chunk):
+        rows = {}
+        for cols in chunk:
+            values = rows[int(cols[GEONAMEID])] = self.entity_values(cols)
+            self.parents.update([values['country_id'], values['state_id']])
+
+        changed = []
+        now = timezone.now()
+        existing = TravelEntity.objects.filter(type=self.type, geonameid__in=rows.keys())
+        for entity in existing.only('id', 'geonameid', *UPDATE_FIELDS):
+            values = rows.pop(entity.geonameid)
+            if all(getattr(entity, key) == value for key, value in values.items()):
+                self.counts['unchanged'] += 1
+            else:
+                self.parents.update([entity.country_id, entity.state_id])
+                TravelEntity.objects.filter(id=entity.id).update(updated=now, **values)
+                changed.append(entity.id)
+                self.counts['updated'] += 1
+
+        TravelEntity.objects.bulk_create([
+            TravelEntity(type=self.type, geonameid=geonameid, full_name=values['name'], **values)
+            for geonameid, values in rows.items()
+        ])
+        self.counts['created'] += len(rows)
+
+        # bulk_create returns no ids here, so new entities get their code (as
+        # load_travel's create_city does) and their search tokens afterwards
+        created = TravelEntity.objects.filter(type=self.type, geonameid__in=rows.keys())
+        created.filter(code='').update(code=F('id'))
+        TravelSearchToken.objects.index(TravelEntity.objects.filter(
+            Q(id__in=changed) | Q(type=self.type, geonameid__in=rows.keys())
+        ).only('id', 'code', *SEARCH_FIELDS))
+        return changed
@@ -1,139 +1,319 @@
-import sys
+'''
+Load subnational entities (and their capitals and flags) from files of lines
+like "co|NL|st|South Holland||ZH|P|The Hague|<flag url>": the parent's type
+and code, then the new entity's type and fields.
+
+Files are streamed and imported in batches, each batch in its own transaction
+with entities created by bulk inserts. Lines that can't be imported are
+written, with the reason, to a reject file that can be fixed and loaded again.
+Flags are fetched afterwards by ``import_flags``, from a manifest written
+alongside the input file.
+'''
+import os
 import codecs
-from pprint import pprint
-from optparse import make_option
-from collections import defaultdict
+from itertools import islice
+from collections import OrderedDict
+from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
-from django.conf import settings
+from django.db import transaction, DatabaseError
+from django.db.models import F
 from travel import models as travel
+from travel import listing as travel_listing
+
+BATCH_SIZE = 500
 
 
 #-------------------------------------------------------------------------------
 def read_entities(fn, delimiter='|'):
-    lines = []
+    '''
+    Yield ``(lineno, fields)`` for each line of ``fn`` that isn't blank or a
+    comment, reading the file as it goes.
+    '''
     with codecs.open(fn, encoding='utf-8') as fp:
-        lineno = 0
-        for line in fp:
-            lineno += 1
+        for lineno, line in enumerate(fp, 1):
             line = line.strip()
             if line and not line.startswith('#'):
-                lines.append((lineno, tuple(line.split(delimiter))))
-                
-    return lines
+                yield lineno, tuple(line.split(delimiter))
 
 
 #===============================================================================
 class TravelEntityCache(object):
+    '''
+    Parent entities keyed on ``(type__abbr, code)``. ``preload`` fetches every
+    entity of the given types in one query per type, so a miss on one of
+    those types is known not to exist without asking the database; anything
+    else is looked up individually on first use. With a ``maxsize``, the least
+    recently used entities are dropped once the cache grows past it, and
+    misses on the types they were dropped from are looked up again.
+    '''
+    
+    #---------------------------------------------------------------------------
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = self.misses = 0
+        self.preloaded = set()
+        self.evicted = set()
+        
+    #---------------------------------------------------------------------------
+    def preload(self, types):
+        for abbr in set(types) - self.preloaded:
+            self.preloaded.add(abbr)
+            qs = travel.TravelEntity.objects.filter(type__abbr=abbr).select_related('country')
+            for entity in qs.iterator():
+                self.add((abbr, entity.code), entity)
     
     #---------------------------------------------------------------------------
-    def __init__(self):
-        self.cache = {}
+    def add(self, key, entity):
+        self.cache.pop(key, None)
+        self.cache[key] = entity
+        if self.maxsize is not None:
+            while len(self.cache) > self.maxsize:
+                (abbr, code), entity = self.cache.popitem(last=False)
+                self.evicted.add(abbr)
         
     #---------------------------------------------------------------------------
     def __getitem__(self, key):
         '''
             `key` should be a tuple of (type__abbr,code)
         '''
-        if not key in self.cache:
-            print 'Getting', key
-            self.cache[key] = travel.TravelEntity.objects.get(type__abbr=key[0], code=key[1])
+        entity = self.cache.get(key)
+        if entity is None:
+            self.misses += 1
+            if key[0] in self.preloaded and key[0] not in self.evicted:
+                raise travel.TravelEntity.DoesNotExist('No %s %s' % key)
+            entity = travel.TravelEntity.objects.get(type__abbr=key[0], code=key[1])
+        else:
+            self.hits += 1
             
-        return self.cache[key]
+        self.add(key, entity)
+        return entity
+    
+    #---------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.cache)
+    
+    #---------------------------------------------------------------------------
+    def stats(self):
+        return 'Entity cache: %d hits, %d misses, %d held' % (self.hits, self.misses, len(self))
 
 
 #===============================================================================
 class TravelEntityLoader(object):
     
     #---------------------------------------------------------------------------
-    def __init__(self):
-        self.types = dict([(et.abbr, et) for et in travel.TravelEntityType.objects.all()]
-        self.cache = TravelEntityCache()
-    
+    def __init__(self, cache_size=None, batch_size=BATCH_SIZE):
+        self.types = dict([(et.abbr, et) for et in travel.TravelEntityType.objects.all()])
+        self.cache = TravelEntityCache(cache_size)
+        self.batch_size = batch_size
+        self.flags = OrderedDict()
+        self.parents = set()
+        self.counts = dict.fromkeys(('imported', 'created', 'rejected'), 0)
+        self.rejects = None
+
     #---------------------------------------------------------------------------
-    def create_flag(self, entity, flag_url):
-        print u'Retrieving flag for %s' % (flag_url, )
-        try:
-            entity.update_flags(flag_url)
-        except Exception, why:
-            print 'Error updating flag'
-            print why
+    def reject(self, lineno, data, why):
+        self.counts['rejected'] += 1
+        print 'Rejected line #%d: %s' % (lineno, why)
+        if self.rejects is None:
+            self.rejects = codecs.open(self.rejects_filename, 'w', encoding='utf-8')
+        self.rejects.write(u'# line %d: %s\n%s\n' % (lineno, why, self.delimiter.join(data)))
 
     #---------------------------------------------------------------------------
-    def create_city(self, co, st, name, full_name=''):
-        city, new = travel.TravelEntity.objects.get_or_create(
-            type=self.types['ct'],
-            name=name,
-            country=co,
-        )
+    def resolve(self, batch):
+        '''
+        Check the lines of ``batch`` and look up their parents, rejecting any
+        that can't be imported. Returns a list of ``(lineno, data, parent, fields)``.
+        '''
+        self.cache.preload(set(data[0] for lineno, data in batch))
+        rows = []
+        for lineno, data in batch:
+            kind, fields = data[2:3], data[3:]
+            if len(data) < 5:
+                self.reject(lineno, data, 'Bad line')
+            elif kind != ('st',):
+                self.reject(lineno, data, 'Unsupported type %s' % (kind or ('',))[0])
+            elif len(fields) != 6:
+                self.reject(lineno, data, 'Expected name|full_name|code|category|capital|flag_url')
+            else:
+                try:
+                    rows.append((lineno, data, self.cache[data[:2]], fields))
+                except travel.TravelEntity.DoesNotExist:
+                    self.reject(lineno, data, 'Unknown parent %s' % '|'.join(data[:2]))
+                
+        return rows
+    
+    #---------------------------------------------------------------------------
+    def bulk_get_or_create(self, type, field, wanted):
+        '''
+        ``wanted`` maps ``(country_id, value of field)`` to unsaved entities of
+        ``type``; returns the same keys mapped to saved entities, inserting
+        only those that don't already exist.
+        '''
+        def fetch(keys):
+            return travel.TravelEntity.objects.filter(
+                type=type,
+                country__in=set(key[0] for key in keys),
+                **{field + '__in': set(key[1] for key in keys)}
+            )
         
+        found = {}
+        for entity in fetch(wanted):
+            found.setdefault((entity.country_id, getattr(entity, field)), entity)
+            
+        new = [entity for key, entity in wanted.items() if key not in found]
         if new:
-            city.full_name = full_name or name
-            city.state     = st
-            city.code      = '%d' % city.id
-            city.save()
-        
-        print 'Got %s city %s' % ('new' if new else 'old', city)
-        return city
-        
-    #-------------------------------------------------------------------------------
-    def create_st(co, fields):
-        name, full_name, code, cat, capital, flag_url = fields
-        print 'Creating %s...' % name
-    
-        attrs = dict(
-            name      = name,
-            full_name = full_name or name,
-            category  = cat
-        )
-    
-        print 'Attrs', attrs
-        subnat, new = travel.TravelEntity.objects.get_or_create(
-            type=self.types['st'],
-            country=co,
-            code=code,
-            defaults=attrs
-        )
+            # bulk_create doesn't set ids, so the new rows are read back
+            existing = set(entity.id for entity in found.values())
+            travel.TravelEntity.objects.bulk_create(new)
+            created = [e for e in fetch(set(wanted) - set(found)) if e.id not in existing]
+            
+            # as with cities created one at a time, a missing code is the id
+            uncoded = [e for e in created if not e.code]
+            travel.TravelEntity.objects.filter(id__in=[e.id for e in uncoded]).update(code=F('id'))
+            for entity in uncoded:
+                entity.code = str(entity.id)
+                
+            travel.TravelSearchToken.objects.index(created)
+            for entity in created:
+                found.setdefault((entity.country_id, getattr(entity, field)), entity)
+            
+            self.counts['created'] += len(created)
+            
+        return found
 
-        print 'Got %s %s: %s' % ('new' if new else 'old', subnat.category_detail, subnat)
-        if capital:
-            subnat.capital = self.create_city(co, subnat, capital)
-            subnat.save()
+    #---------------------------------------------------------------------------
+    def import_batch(self, rows):
+        states, cities = OrderedDict(), OrderedDict()
+        for lineno, data, co, fields in rows:
+            name, full_name, code, cat, capital, flag_url = fields
+            states.setdefault((co.id, code), travel.TravelEntity(
+                type=self.types['st'],
+                country=co,
+                code=code,
+                name=name,
+                full_name=full_name or name,
+                category=cat
+            ))
         
-        if flag_url:
-            self.create_flag(subnat, flag_url)
+        states = self.bulk_get_or_create(self.types['st'], 'code', states)
+        for lineno, data, co, fields in rows:
+            capital = fields[4]
+            if capital:
+                cities.setdefault((co.id, capital), travel.TravelEntity(
+                    type=self.types['ct'],
+                    country=co,
+                    state=states[(co.id, fields[2])],
+                    name=capital,
+                    full_name=capital,
+                ))
+                
+        cities = self.bulk_get_or_create(self.types['ct'], 'name', cities)
+        flags = []
+        for lineno, data, co, fields in rows:
+            state = states[(co.id, fields[2])]
+            capital, flag_url = fields[4], fields[5]
+            if capital and state.capital_id != cities[(co.id, capital)].id:
+                state.capital = cities[(co.id, capital)]
+                travel.TravelEntity.objects.filter(id=state.id).update(capital=state.capital)
+                
+            if flag_url:
+                flags.append(('{}-{}'.format(co.code, state.code), flag_url))
+                
+            self.parents.update([co.id, state.id])
+            
+        return flags
         
-        return subnat
-
-    #-------------------------------------------------------------------------------
-    def process_entity_file(filename, delimiter='|'):
+    #---------------------------------------------------------------------------
+    def process_entity_file(self, filename, delimiter='|', rejects=None):
         #co|NL|st|South Holland||ZH|P|The Hague|http://upload.wikimedia.org/wikipedia/commons/thumb/6/63/Flag_Zuid-Holland.svg/27px-Flag_Zuid-Holland.svg.png
+        print 'File:', filename
+        self.delimiter = delimiter
+        self.rejects_filename = rejects or filename + '.rejects'
+        if os.path.exists(self.rejects_filename):
+            # left by an earlier run; this one writes its own, if it rejects any
+            os.remove(self.rejects_filename)
+
         lines = read_entities(filename, delimiter)
-        print 'File:', filename, 'Lines:', len(lines)
-    
-        for lineno, data in lines:
-            if len(data) < 5:
-                print 'Bad line #%d: %s' % (lineno, data)
-            else:
-                keys, kind, fields = data[:2], data[2], data[3:]
-                handler = _entity_creation_handlers.get(kind)
-                if kind == 'st':
-                    parent = self.cache[keys]
-                    entity = self.create_st(parent, fields)
-                    print 'TravelEntity: %s' % entity
-                
+        try:
+            while True:
+                batch = list(islice(lines, self.batch_size))
+                if not batch:
+                    break
+                    
+                rows = self.resolve(batch)
+                created = self.counts['created']
+                try:
+                    with transaction.atomic():
+                        flags = self.import_batch(rows)
+                except DatabaseError as why:
+                    # the whole batch was rolled back
+                    self.counts['created'] = created
+                    for lineno, data, co, fields in rows:
+                        self.reject(lineno, data, why)
                 else:
-                    print 'Skipped: %s, Line  #%d' % (kind, lineno)
-
-            print '-' * 40
+                    self.counts['imported'] += len(rows)
+                    self.flags.update(flags)
+                    
+                print 'Line #%d: %d created, %d rejected' % (
+                    batch[-1][0], self.counts['created'], self.counts['rejected']
+                )
+        finally:
+            if self.rejects is not None:
+                self.rejects.close()
+                self.rejects = None
+                
+    #---------------------------------------------------------------------------
+    def finish(self):
+        for abbr in ('st', 'ct'):
+            travel_listing.invalidate_listing(abbr)
+        
+        # continents relate to entities through their country's continent as well
+        self.parents.update(travel.TravelEntity.objects.filter(
+            id__in=self.parents
+        ).values_list('continent', flat=True))
+        self.parents.discard(None)
+        travel.TravelEntity.objects.invalidate_relationships(self.parents)
+        
+    #---------------------------------------------------------------------------
+    def write_flag_manifest(self, filename):
+        with codecs.open(filename, 'w', encoding='utf-8') as fp:
+            for code, flag_url in self.flags.items():
+                fp.write(u'st|%s|%s\n' % (code, flag_url))
 
 
 #===============================================================================
 class Command(BaseCommand):
     help = ' '.join([line.strip() for line in __doc__.strip().splitlines()])
 
+    #---------------------------------------------------------------------------
+    def add_arguments(self, parser):
+        parser.add_argument('filenames', nargs='+')
+        parser.add_argument('--cache-size', type=int, default=None,
+            help='Most parent entities to hold in memory; unbounded by default')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Lines per transaction')
+        parser.add_argument('--delimiter', default='|')
+        parser.add_argument('--flags', default=None,
+            help='Flag manifest to write for import_flags; defaults to <first filename>.flags')
+        parser.add_argument('--skip-flags', action='store_true',
+            help='Only write the flag manifest, without running import_flags')
+
     #---------------------------------------------------------------------------
     def handle(self, *args, **options):
-        loader = TravelEntityLoader()
-        for arg in args:
-            loader.process_entity_file(arg)
+        loader = TravelEntityLoader(options['cache_size'], options['batch_size'])
+        for filename in options['filenames']:
+            loader.process_entity_file(filename, options['delimiter'])
+            
+        loader.finish()
+        print 'Imported {imported} lines ({created} entities created), rejected {rejected}'.format(
+            **loader.counts
+        )
+        print loader.cache.stats()
         
+        if loader.flags:
+            manifest = options['flags'] or options['filenames'][0] + '.flags'
+            loader.write_flag_manifest(manifest)
+            if options['skip_flags']:
+                print 'Flags written to %s; load them with import_flags' % manifest
+            else:
+                call_command('import_flags', manifest, restart=True)
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from travel import profiling
+
+
+#===============================================================================
+class Command(BaseCommand):
+    help = 'Print the per-view histograms recorded by travel.profiling.ProfilingMiddleware'
+
+    #---------------------------------------------------------------------------
+    def add_arguments(self, parser):
+        parser.add_argument('views', nargs='*', help='Only views whose name contains one of these')
+        parser.add_argument('--histograms', action='store_true', help='Print the bucket counts too')
+        parser.add_argument('--reset', action='store_true', help='Clear the recorded measurements')
+
+    #---------------------------------------------------------------------------
+    def handle(self, *args, **options):
+        if options['reset']:
+            profiling.reset()
+            self.stdout.write('Profile cleared')
+            return
+
+        views = [
+            view for view in profiling.views()
+            if not options['views'] or any(name in view for name in options['views'])
+        ]
+        if not views:
+            self.stdout.write('Nothing recorded; is TRAVEL_PROFILE_VIEWS on?')
+
+        bounds = dict(profiling.HISTOGRAM_BOUNDS)
+        for view in views:
+            count, results = profiling.histograms(view)
+            self.stdout.write('{} ({} requests)'.format(view, count))
+            for metric in profiling.METRICS:
+                if metric not in results:
+                    continue
+
+                result = results[metric]
+                self.stdout.write('    {:<12} mean {:>9.1f}   p50 <= {:<6} p95 <= {:<6}'.format(
+                    metric, result['mean'], result['p50'], result['p95']
+                ))
+                if options['histograms']:
+                    labels = ['<= {}'.format(bound) for bound in bounds[metric]]
+                    labels.append('>  {}'.format(bounds[metric][-1]))
+                    for label, n in zip(labels, result['counts']):
+                        if n:
+                            self.stdout.write('        {:<10} {:>7} {}'.format(
+                                label, n, '#' * max(1, 40 * n // result['n'])
+                            ))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from travel.models import TravelLog, TravelLogSummary
+
+#===============================================================================
+class Command(BaseCommand):
+    help = 'Rebuild the per-user, per-entity travel log summary table from scratch'
+
+    #---------------------------------------------------------------------------
+    def handle(self, *args, **options):
+        TravelLogSummary.objects.rebuild(TravelLog.objects.all())
+        self.stdout.write('Summarized {} travel logs into {} rows'.format(
+            TravelLog.objects.count(),
+            TravelLogSummary.objects.count()
+        ))
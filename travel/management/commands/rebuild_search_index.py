@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from travel.models import TravelEntity, TravelSearchToken
+
+#===============================================================================
+class Command(BaseCommand):
+    help = 'Rebuild the n-gram search index for all travel entities'
+
+    #---------------------------------------------------------------------------
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    #---------------------------------------------------------------------------
+    def handle(self, *args, **options):
+        TravelSearchToken.objects.rebuild(TravelEntity.objects.all(), options['batch_size'])
+        self.stdout.write('Indexed {} entities, {} tokens'.format(
+            TravelEntity.objects.count(),
+            TravelSearchToken.objects.count()
+        ))
@@ -0,0 +1,35 @@
+import timeit
+from django.core.management.base import BaseCommand
+from travel.models import TravelEntity
+from travel.search import QuerySearchBackend, IndexSearchBackend
+
+DEFAULT_TERMS = ('san', 'new york', 'paris', 'US', 'international airport')
+
+#===============================================================================
+class Command(BaseCommand):
+    help = 'Compare the indexed search backend with the plain query backend'
+
+    #---------------------------------------------------------------------------
+    def add_arguments(self, parser):
+        parser.add_argument('terms', nargs='*')
+        parser.add_argument('--repeat', type=int, default=10)
+        parser.add_argument('--type', default=None)
+
+    #---------------------------------------------------------------------------
+    def handle(self, *args, **options):
+        backends = (('query', QuerySearchBackend()), ('index', IndexSearchBackend()))
+        repeat = options['repeat']
+        for term in options['terms'] or DEFAULT_TERMS:
+            results = {}
+            for name, backend in backends:
+                run = lambda: list(backend.search(
+                    TravelEntity.objects.all(), term, options['type']
+                ).values_list('id', flat=True))
+                elapsed = timeit.timeit(run, number=repeat) / repeat
+                results[name] = set(run())
+                self.stdout.write('{:<24} {:<6} {:>7} results {:>10.2f} ms'.format(
+                    term, name, len(results[name]), elapsed * 1000
+                ))
+
+            if results['query'] != results['index']:
+                self.stderr.write('** Result mismatch for {!r}'.format(term))
@@ -1,11 +1,18 @@
+import hashlib
 import operator
-from django.db.models import Manager, Q, Count, Min, Max
+from collections import defaultdict
+from django.core.cache import cache
+from django.db.models import Manager, Q, F, Count, Min, Max
+from travel import utils as travel_utils
+from travel.search import get_search_backend, entity_tokens
 
 __all__ = (
     'TravelProfileManager',
     'TravelBucketListManager',
     'TravelEntityManager',
     'TravelLogManager', 
+    'TravelSearchTokenManager',
+    'TravelLogSummaryManager',
 )
 
 
@@ -49,35 +56,151 @@ class TravelBucketListManager(Manager):
 #===============================================================================
 class TravelEntityManager(Manager):
 
-    #---------------------------------------------------------------------------
-    @staticmethod
-    def _search_q(term):
-        return (
-            Q(name__icontains=term)      |
-            Q(full_name__icontains=term) |
-            Q(locality__icontains=term)  |
-            Q(code__iexact=term)
-        )
-        
+    # The fields relating child entities to a parent entity of each type
+    RELATED_FIELDS = {
+        'co': ('country',),
+        'st': ('state',),
+        'cn': ('continent', 'country__continent'),
+    }
+
     #---------------------------------------------------------------------------
     def search(self, term, type=None):
-        term = term.strip() if term else term
-        qs = None
-        if term:
-            qs = self.filter(self._search_q(term))
-        
-        if type:
-            qs = qs or self
-            qs = qs.filter(type__abbr=type)
-            
-        return self.none() if qs is None else qs
+        return get_search_backend().search(self.all(), term, type)
     
     #---------------------------------------------------------------------------
     def advanced_search(self, bits, type=None):
-        qq = reduce(operator.ior, [self._search_q(term) for term in bits])
-        qs = self.filter(qq)
-        return qs.filter(type__abbr=type) if type else qs
+        return get_search_backend().advanced_search(self.all(), bits, type)
+    
+    #---------------------------------------------------------------------------
+    def batch_search(self, lines, type=None):
+        qs = self.select_related('type', 'flag', 'country__flag')
+        return get_search_backend().batch_search(qs, lines, type)
     
+    #---------------------------------------------------------------------------
+    def in_bbox(self, south, west, north, east, type=None):
+        '''
+        Entities inside a bounding box, narrowed through the indexed
+        ``geocell`` column. ``west > east`` means the box crosses the
+        antimeridian.
+        '''
+        cells = reduce(operator.ior, [
+            Q(geocell__range=cell_range)
+            for cell_range in travel_utils.geocell_ranges(south, west, north, east)
+        ])
+        lon = Q(lon__gte=west, lon__lte=east)
+        if west > east:
+            lon = Q(lon__gte=west) | Q(lon__lte=east)
+
+        qs = self.filter(cells, lon, lat__gte=south, lat__lte=north)
+        return qs.filter(type__abbr=type) if type else qs
+
+    #---------------------------------------------------------------------------
+    def within_radius(self, lat, lon, km, type=None):
+        '''
+        Entities within ``km`` of a point, nearest first, each with a
+        ``distance`` attribute in kilometres.
+        '''
+        results = []
+        bbox = travel_utils.radius_bbox(lat, lon, km)
+        for entity in self.in_bbox(*bbox, type=type).select_related('type', 'country'):
+            entity.distance = travel_utils.haversine_km(lat, lon, entity.lat, entity.lon)
+            if entity.distance <= km:
+                results.append(entity)
+
+        results.sort(key=lambda e: e.distance)
+        return results
+
+    #---------------------------------------------------------------------------
+    @staticmethod
+    def _relationships_key(entity_id):
+        return 'travel:relationships:{}'.format(entity_id)
+
+    #---------------------------------------------------------------------------
+    def relationship_counts(self, entities):
+        '''
+        Map the id of each of ``entities`` to a list of ``(abbr, count)`` for
+        the entities related to it, by type. Results are cached until a child
+        entity is added, moved or deleted; the misses are computed together
+        with one grouped query per relating field.
+        '''
+        keys = dict((self._relationships_key(e.id), e) for e in entities)
+        cached = cache.get_many(keys.keys())
+        results = dict((keys[key].id, value) for key, value in cached.items())
+
+        by_field = defaultdict(list)
+        missing = [e for key, e in keys.items() if key not in cached]
+        for entity in missing:
+            for field in self.RELATED_FIELDS.get(entity.type.abbr, ()):
+                by_field[field].append(entity.id)
+
+        counts = defaultdict(lambda: defaultdict(int))
+        for field, ids in by_field.items():
+            qs = self.filter(**{field + '__in': ids})
+            if field == 'country__continent':
+                # don't count twice entities already related by their own continent
+                qs = qs.exclude(continent=F('country__continent'))
+
+            qs = qs.order_by().values_list(field, 'type', 'type__abbr')
+            for parent_id, type_id, abbr, cnt in qs.annotate(cnt=Count('id')):
+                counts[parent_id][(type_id, abbr)] += cnt
+
+        updates = {}
+        for entity in missing:
+            value = [(abbr, cnt) for (_, abbr), cnt in sorted(counts[entity.id].items())]
+            results[entity.id] = updates[self._relationships_key(entity.id)] = value
+
+        cache.set_many(updates, None)
+        return results
+
+    #---------------------------------------------------------------------------
+    def invalidate_relationships(self, entity_ids):
+        cache.delete_many([self._relationships_key(pk) for pk in entity_ids if pk])
+
+    #---------------------------------------------------------------------------
+    @staticmethod
+    def _timezone_key(entity_id):
+        return 'travel:timezone:{}'.format(entity_id)
+
+    #---------------------------------------------------------------------------
+    def timezones(self, entity_ids):
+        '''
+        Map each of ``entity_ids`` to its effective timezone name: its own,
+        else its state's, else its country's, else UTC. Results are cached
+        until the entity or one of its parents changes timezone; the misses
+        are resolved together in a single query.
+        '''
+        keys = dict((self._timezone_key(pk), pk) for pk in set(entity_ids))
+        cached = cache.get_many(keys.keys())
+        results = dict((keys[key], value) for key, value in cached.items())
+
+        missing = [pk for key, pk in keys.items() if key not in cached]
+        if missing:
+            updates = {}
+            qs = self.filter(id__in=missing).order_by().values_list(
+                'id', 'tz', 'state__tz', 'state__country__tz', 'country__tz'
+            )
+            for row in qs:
+                tz = next((name for name in row[1:] if name), 'UTC')
+                results[row[0]] = updates[self._timezone_key(row[0])] = tz
+
+            cache.set_many(updates, None)
+
+        return results
+
+    #---------------------------------------------------------------------------
+    def invalidate_timezones(self, entity_ids):
+        '''
+        Drop the cached timezones of ``entity_ids`` and of the entities that
+        inherit theirs from them.
+        '''
+        ids = set(entity_ids)
+        if not ids:
+            return
+
+        children = self.filter(Q(state__in=ids) | Q(country__in=ids) | Q(state__country__in=ids))
+        ids.update(children.values_list('id', flat=True))
+        cache.delete_many([self._timezone_key(pk) for pk in ids])
+
     #---------------------------------------------------------------------------
     def countries(self):
         return self.filter(type__abbr='co')
@@ -102,8 +225,104 @@ class TravelEntityManager(Manager):
 #===============================================================================
 class TravelLogManager(Manager):
 
+    #---------------------------------------------------------------------------
+    @staticmethod
+    def _checklist_key(user_id):
+        return 'travel:checklist:{}'.format(user_id)
+
     #---------------------------------------------------------------------------
     def checklist(self, user):
-        return dict(
-            self.filter(user=user).values_list('entity').annotate(count=Count('entity'))
+        key = self._checklist_key(user.id)
+        result = cache.get(key)
+        if result is None:
+            result = dict(user.travel_summaries.values_list('entity_id', 'count'))
+            cache.set(key, result)
+        return result
+
+    #---------------------------------------------------------------------------
+    def invalidate_checklist(self, user_id):
+        cache.delete(self._checklist_key(user_id))
+
+    #---------------------------------------------------------------------------
+    @staticmethod
+    def _history_key(user_id, version):
+        return 'travel:history:{}:{}'.format(user_id, version)
+
+    #---------------------------------------------------------------------------
+    def history(self, user, version):
+        '''
+        The cached ``history_json`` of ``user`` in format ``version``, as a
+        dict of its ``content`` and an ``etag``.
+        '''
+        key = self._history_key(user.id, version)
+        result = cache.get(key)
+        if result is None:
+            content = self.model.history_json(user, version)
+            result = {'content': content, 'etag': hashlib.md5(content).hexdigest()}
+            cache.set(key, result)
+        return result
+
+    #---------------------------------------------------------------------------
+    def invalidate_history(self, user_id):
+        cache.delete_many([
+            self._history_key(user_id, version)
+            for version in self.model.HISTORY_VERSIONS
+        ])
+
+
+#===============================================================================
+class TravelSearchTokenManager(Manager):
+
+    #---------------------------------------------------------------------------
+    def _create_tokens(self, entities):
+        self.bulk_create([
+            self.model(entity_id=entity.id, token=token)
+            for entity in entities
+            for token in entity_tokens(entity)
+        ])
+
+    #---------------------------------------------------------------------------
+    def index(self, entities):
+        entities = list(entities)
+        self.filter(entity__in=entities).delete()
+        self._create_tokens(entities)
+
+    #---------------------------------------------------------------------------
+    def rebuild(self, queryset, batch_size=1000):
+        self.all().delete()
+        last_id = 0
+        while True:
+            batch = list(queryset.filter(id__gt=last_id).order_by('id')[:batch_size])
+            if not batch:
+                break
+
+            self._create_tokens(batch)
+            last_id = batch[-1].id
+
+
+#===============================================================================
+class TravelLogSummaryManager(Manager):
+
+    #---------------------------------------------------------------------------
+    def refresh(self, logs, user_id, entity_id):
+        stats = logs.filter(user=user_id, entity=entity_id).aggregate(
+            count=Count('id'),
+            first_arrival=Min('arrival'),
+            last_arrival=Max('arrival')
         )
+        if stats['count']:
+            self.update_or_create(user_id=user_id, entity_id=entity_id, defaults=stats)
+        else:
+            self.filter(user=user_id, entity=entity_id).delete()
+
+    #---------------------------------------------------------------------------
+    def rebuild(self, logs):
+        self.all().delete()
+        self.bulk_create([
+            self.model(user_id=row.pop('user'), entity_id=row.pop('entity'), **row)
+            for row in logs.order_by().values('user', 'entity').annotate(
+                count=Count('id'),
+                first_arrival=Min('arrival'),
+                last_arrival=Max('arrival')
+            ).iterator()
+        ], batch_size=1000)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# as in travel.search when this migration was written; copied, so that later
+# changes there can't change what the migration does
+NGRAM_SIZE = 3
+CODE_TOKEN = '#{}'
+SEARCH_FIELDS = ('name', 'full_name', 'locality')
+
+
+def entity_tokens(entity):
+    tokens = set()
+    for attr in SEARCH_FIELDS:
+        text = (getattr(entity, attr) or '').lower()
+        tokens.update(text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1))
+
+    if entity.code:
+        tokens.add(CODE_TOKEN.format(entity.code.lower()))
+
+    return tokens
+
+
+def build_search_index(apps, schema_editor):
+    TravelEntity = apps.get_model('travel', 'TravelEntity')
+    TravelSearchToken = apps.get_model('travel', 'TravelSearchToken')
+    for entity in TravelEntity.objects.iterator():
+        TravelSearchToken.objects.bulk_create([
+            TravelSearchToken(entity=entity, token=token)
+            for token in entity_tokens(entity)
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TravelSearchToken',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('token', models.CharField(max_length=8)),
+                ('entity', models.ForeignKey(related_name='search_tokens', to='travel.TravelEntity')),
+            ],
+            options={
+                'db_table': 'travel_search_token',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='travelsearchtoken',
+            unique_together=set([('token', 'entity')]),
+        ),
+        migrations.RunPython(build_search_index, migrations.RunPython.noop),
+    ]
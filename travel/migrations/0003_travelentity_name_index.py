@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0002_travelsearchtoken'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='travelentity',
+            name='name',
+            field=models.CharField(max_length=175, db_index=True),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+from django.db.models import Count, Min, Max
+
+
+def build_log_summary(apps, schema_editor):
+    TravelLog = apps.get_model('travel', 'TravelLog')
+    TravelLogSummary = apps.get_model('travel', 'TravelLogSummary')
+    TravelLogSummary.objects.bulk_create([
+        TravelLogSummary(user_id=row.pop('user'), entity_id=row.pop('entity'), **row)
+        for row in TravelLog.objects.order_by().values('user', 'entity').annotate(
+            count=Count('id'),
+            first_arrival=Min('arrival'),
+            last_arrival=Max('arrival')
+        )
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('travel', '0003_travelentity_name_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TravelLogSummary',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('first_arrival', models.DateTimeField()),
+                ('last_arrival', models.DateTimeField()),
+                ('entity', models.ForeignKey(related_name='+', to='travel.TravelEntity')),
+                ('user', models.ForeignKey(related_name='travel_summaries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'travel_log_summary',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='travellogsummary',
+            unique_together=set([('user', 'entity')]),
+        ),
+        migrations.RunPython(build_log_summary, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from travel.utils import geocell
+
+
+def fill_geocells(apps, schema_editor):
+    TravelEntity = apps.get_model('travel', 'TravelEntity')
+    for entity in TravelEntity.objects.filter(lat__isnull=False, lon__isnull=False).iterator():
+        TravelEntity.objects.filter(id=entity.id).update(geocell=geocell(entity.lat, entity.lon))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0004_travellogsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='travelentity',
+            name='geocell',
+            field=models.IntegerField(db_index=True, null=True, editable=False, blank=True),
+        ),
+        migrations.RunPython(fill_geocells, migrations.RunPython.noop),
+    ]
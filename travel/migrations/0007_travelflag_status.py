@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0006_travelentity_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='travelflag',
+            name='status',
+            field=models.CharField(default='R', max_length=1, choices=[('R', 'Ready'), ('P', 'Pending'), ('F', 'Failed')]),
+        ),
+        migrations.AddField(
+            model_name='travelflag',
+            name='status_message',
+            field=models.CharField(max_length=255, blank=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0007_travelflag_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='travelflag',
+            name='checksum',
+            field=models.CharField(max_length=40, blank=True),
+        ),
+    ]
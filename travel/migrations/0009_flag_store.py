@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import hashlib
+import tempfile
+from django.conf import settings
+from django.db import migrations
+
+# as in travel.models when this migration was written; copied, so that later
+# changes there can't change what the migration does
+FLAG_STORE_DIR = 'travel/img/flags/store'
+
+
+def store_flag_file(data, ext):
+    digest = hashlib.sha1(data).hexdigest()
+    name = '{}/{}/{}.{}'.format(FLAG_STORE_DIR, digest[:2], digest, ext)
+    path = os.path.join(settings.MEDIA_ROOT, name)
+    if not os.path.exists(path):
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+
+    return name
+
+
+def move_to_flag_store(apps, schema_editor):
+    '''
+    Copy existing flag files into the content-addressed store. An SVG whose
+    file is gone is cleared, as ``image_url`` no longer checks for it.
+    '''
+    TravelFlag = apps.get_model('travel', 'TravelFlag')
+    for flag in TravelFlag.objects.iterator():
+        updates = {}
+        for attr, ext in (('thumb', 'png'), ('large', 'png'), ('svg', 'svg')):
+            name = getattr(flag, attr).name
+            if not name or name.startswith(FLAG_STORE_DIR):
+                continue
+
+            path = os.path.join(settings.MEDIA_ROOT, name)
+            if os.path.exists(path):
+                with open(path, 'rb') as fp:
+                    updates[attr] = store_flag_file(fp.read(), ext)
+            elif attr == 'svg':
+                updates[attr] = ''
+
+        if updates:
+            TravelFlag.objects.filter(id=flag.id).update(**updates)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0008_travelflag_checksum'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_to_flag_store, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0009_flag_store'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='travellog',
+            index_together=set([
+                ('user', 'entity', 'arrival'),
+                ('user', 'arrival', 'entity', 'rating'),
+            ]),
+        ),
+    ]
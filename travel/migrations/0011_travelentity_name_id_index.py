@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0010_travellog_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='travelentity',
+            index_together=set([('name', 'id')]),
+        ),
+    ]
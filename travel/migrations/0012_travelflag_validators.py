@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0011_travelentity_name_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='travelflag',
+            name='etag',
+            field=models.CharField(max_length=255, blank=True),
+        ),
+        migrations.AddField(
+            model_name='travelflag',
+            name='last_modified',
+            field=models.CharField(max_length=40, blank=True),
+        ),
+    ]
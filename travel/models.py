@@ -1,6 +1,10 @@
 import re
 import os
-from collections import Counter
+import json
+import hashlib
+import calendar
+import tempfile
+from collections import OrderedDict
 
 from django.conf import settings
 from django.db import models
@@ -12,9 +16,9 @@ from django.utils.functional import cached_property
 from django.utils import six
 from django.utils.encoding import python_2_unicode_compatible
 
-import pytz
 from choice_enum import ChoiceEnumeration
 import travel.utils as travel_utils
+import travel.listing as travel_listing
 from .managers import *
 
 GOOGLE_MAPS             = 'http://maps.google.com/maps?q={}'
@@ -22,7 +26,14 @@ GOOGLE_MAPS_LATLON      = 'http://maps.google.com/maps?q={},+{}&iwloc=A&z=10'
 WIKIPEDIA_URL           = 'http://en.wikipedia.org/wiki/Special:Search?search={}&go=Go'
 WORLD_HERITAGE_URL      = 'http://whc.unesco.org/en/list/{}'
 BASE_FLAG_DIR           = 'travel/img/flags'
+FLAG_STORE_DIR          = BASE_FLAG_DIR + '/store'
 STAR                    = mark_safe('&#9733;')
+NEARBY_KM               = 50
+NEARBY_LIMIT            = 10
+HISTORY_ENTITY_FIELDS   = (
+    'id', 'code', 'name', 'locality', 'country__name', 'country__code',
+    'country__flag__thumb', 'type__abbr', 'flag__thumb'
+)
 WORLD_HERITAGE_CATEGORY = { 'C': 'Cultural', 'N': 'Natural', 'M': 'Mixed' }
 SUBNATIONAL_CATEGORY    = {
     'A': 'Autonomous Community',
@@ -37,6 +48,17 @@ SUBNATIONAL_CATEGORY    = {
     'T': 'Territory',
 }
 
+#-------------------------------------------------------------------------------
+def category_detail(abbr, category, title):
+    if abbr == 'wh':
+        return WORLD_HERITAGE_CATEGORY.get(category, 'Unknown')
+
+    elif abbr == 'st':
+        return SUBNATIONAL_CATEGORY.get(category, title)
+    
+    return title
+
+
 #-------------------------------------------------------------------------------
 # A few migration/PY2 hoops to jump through here, must have module level funcs
 # for the ``upload_to`` param for FileFields and ImageFields
@@ -56,8 +78,47 @@ def svg_upload(instance, filename):
     return  '{}/{}/flag.svg'.format(BASE_FLAG_DIR, instance.base_dir)
 
 
+#-------------------------------------------------------------------------------
+def store_flag_file(data, ext):
+    '''
+    Write ``data`` under ``FLAG_STORE_DIR``, named by its SHA-1, returning
+    the media-relative name. Identical files are stored only once, and since
+    a stored file never changes it can be served with far-future caching.
+    '''
+    digest = hashlib.sha1(data).hexdigest()
+    name = '{}/{}/{}.{}'.format(FLAG_STORE_DIR, digest[:2], digest, ext)
+    path = os.path.join(settings.MEDIA_ROOT, name)
+    if not os.path.exists(path):
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        # write aside and rename, so a partial file is never visible under the name
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+
+    return name
+
+
+#-------------------------------------------------------------------------------
+def _invalidate_flag_game():
+    # imported here, since flag_game depends on this module
+    from travel.extras import flag_game
+    flag_game.invalidate_flag_game_data()
+
+
 #===============================================================================
 class TravelFlag(models.Model):
+
+    #===========================================================================
+    class Status(ChoiceEnumeration):
+        READY   = ChoiceEnumeration.Option('R', 'Ready', default=True)
+        PENDING = ChoiceEnumeration.Option('P', 'Pending')
+        FAILED  = ChoiceEnumeration.Option('F', 'Failed')
+
     source = models.CharField(max_length=255)
     base_dir = models.CharField(max_length=8)
     ref = models.CharField(max_length=6)
@@ -65,51 +126,59 @@ class TravelFlag(models.Model):
     large = models.ImageField(upload_to=flag_upload_128, blank=True)
     svg = models.FileField(upload_to=svg_upload, blank=True)
     is_locked = models.BooleanField(default=False)
+    checksum = models.CharField(max_length=40, blank=True)
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=40, blank=True)
+    status = models.CharField(max_length=1, choices=Status.CHOICES, default=Status.DEFAULT)
+    status_message = models.CharField(max_length=255, blank=True)
     
     #===========================================================================
     class Meta:
         db_table = 'travel_flag'
     
+    #---------------------------------------------------------------------------
+    is_ready   = property(lambda self: self.status == self.Status.READY)
+    is_pending = property(lambda self: self.status == self.Status.PENDING)
+    is_failed  = property(lambda self: self.status == self.Status.FAILED)
+
+    #---------------------------------------------------------------------------
+    def set_status(self, status, message=''):
+        # update only the status columns, leaving any concurrent image update be
+        self.status, self.status_message = status, message[:255]
+        TravelFlag.objects.filter(id=self.id).update(
+            status=self.status,
+            status_message=self.status_message
+        )
+    
     #---------------------------------------------------------------------------
     @property
     def image_url(self):
-        if self.svg:
-            if os.path.exists(self.svg.path):
-                return self.svg.url
-        return self.large.url
-    
-    #---------------------------------------------------------------------------
-    def update(self, url, base, ref, svg, thumb, large):
-        join        = os.path.join
-        ref         = ref.lower()
-        media_root  = settings.MEDIA_ROOT
-        parent_dir  = join(BASE_FLAG_DIR, base, ref)
-        abs_dir     = join(media_root, parent_dir)
-        path_fmt    = join(parent_dir, '{}-{{}}.png'.format(ref))
-
-        if not os.path.exists(abs_dir):
-            os.makedirs(abs_dir)
-        
+        return self.svg.url if self.svg else self.large.url
+    
+    #---------------------------------------------------------------------------
+    def update(self, url, base, ref, svg, thumb, large, checksum=''):
+        self.store(url, base, ref, svg, thumb, large, checksum)
+        self.save()
+        _invalidate_flag_game()
+
+    #---------------------------------------------------------------------------
+    def store(self, url, base, ref, svg, thumb, large, checksum='', etag='', last_modified=''):
+        '''
+        Write the image files and set the fields for them, without saving.
+        ``checksum`` identifies the content downloaded from ``url``, and
+        ``etag`` and ``last_modified`` are the validators it was served with,
+        for asking whether it has changed since.
+        '''
         self.source   = url
+        self.checksum = checksum
+        self.etag     = etag
+        self.last_modified = last_modified
         self.base_dir = base
-        self.ref      = ref
-        self.svg      = None
-        
-        for attr, data, size in (('thumb', thumb, 32), ('large', large, 128)):
-            if data:
-                flag_path = path_fmt.format(size)
-                setattr(self, attr, flag_path)
-                with open(join(media_root, flag_path), 'wb') as fp:
-                    fp.write(data)
-            else:
-                setattr(self, attr, None)
-        
-        if svg:
-            self.svg = join(parent_dir, 'flag.svg')
-            with open(join(media_root, parent_dir, 'flag.svg'), 'wb') as fp:
-                fp.write(svg)
-        
-        self.save()
+        self.ref      = ref.lower()
+        self.thumb    = store_flag_file(thumb, 'png') if thumb else None
+        self.large    = store_flag_file(large, 'png') if large else None
+        self.svg      = store_flag_file(svg, 'svg') if svg else None
+        self.status, self.status_message = self.Status.READY, ''
 
 
 #===============================================================================
@@ -142,10 +211,9 @@ class TravelBucketList(models.Model):
         if not user.is_authenticated():
             return 0, [(e, 0) for e in all_entities]
 
-        logged_entities = Counter(TravelLog.objects.filter(
-            user=user,
+        logged_entities = dict(user.travel_summaries.filter(
             entity__in=all_entities
-        ).values_list('entity__id', flat=True))
+        ).values_list('entity_id', 'count'))
 
         entities = [
             (entity, logged_entities.get(entity.id, 0))
@@ -154,6 +222,64 @@ class TravelBucketList(models.Model):
         done = sum([1 if b else 0 for a,b in entities])
         return done, entities
 
+    #---------------------------------------------------------------------------
+    def compare(self, usernames):
+        return BucketListComparison(self, usernames)
+
+
+#===============================================================================
+class BucketListComparison(object):
+    '''
+    Which of a bucket list's entities each of ``usernames`` has logged,
+    resolved for all users at once with a single query.
+
+    Each user's row is a bitmap over ``entities``: bit ``i`` is set when the
+    user has logged ``entities[i]``.
+    '''
+
+    #---------------------------------------------------------------------------
+    def __init__(self, bucket_list, usernames):
+        self.bucket_list = bucket_list
+        self.usernames = list(OrderedDict.fromkeys(usernames))
+        self.bitmaps = dict.fromkeys(self.usernames, 0)
+
+        self.entities = list(bucket_list.entities.select_related('type', 'flag', 'country'))
+        positions = dict((e.id, i) for i, e in enumerate(self.entities))
+        for username, entity_id in TravelLogSummary.objects.filter(
+            user__username__in=self.usernames,
+            entity__in=positions.keys()
+        ).values_list('user__username', 'entity_id').iterator():
+            self.bitmaps[username] = self.bitmaps.get(username, 0) | 1 << positions[entity_id]
+
+    #---------------------------------------------------------------------------
+    def visited(self, username):
+        bitmap = self.bitmaps[username]
+        return set(e.id for i, e in enumerate(self.entities) if bitmap >> i & 1)
+
+    #---------------------------------------------------------------------------
+    @property
+    def results(self):
+        return [
+            {'username': username, 'entities': self.visited(username)}
+            for username in self.usernames
+        ]
+
+    #---------------------------------------------------------------------------
+    def as_dict(self):
+        '''
+        Bitmaps are hex encoded, with the least significant bit for the
+        first entity.
+        '''
+        return {
+            'bucket_list': self.bucket_list.id,
+            'entities': [e.id for e in self.entities],
+            'users': self.usernames,
+            'bitmaps': dict(
+                (username, '{:x}'.format(bitmap))
+                for username, bitmap in self.bitmaps.items()
+            )
+        }
+
 
 #===============================================================================
 @python_2_unicode_compatible
@@ -259,7 +385,7 @@ class TravelEntity(models.Model):
     geonameid = models.IntegerField(default=0)
     type      = models.ForeignKey(TravelEntityType, related_name='entity_set')
     code      = models.CharField(max_length=6, db_index=True)
-    name      = models.CharField(max_length=175)
+    name      = models.CharField(max_length=175, db_index=True)
     full_name = models.CharField(max_length=175)
     lat       = models.DecimalField(max_digits=7, decimal_places=4, null=True, blank=True)
     lon       = models.DecimalField(max_digits=7, decimal_places=4, null=True, blank=True)
@@ -272,6 +398,8 @@ class TravelEntity(models.Model):
     country   = models.ForeignKey('self', related_name='country_set',   blank=True, null=True)
     continent = models.ForeignKey('self', related_name='continent_set', blank=True, null=True)
     tz        = models.CharField('timezone', max_length=40, blank=True)
+    geocell   = models.IntegerField(null=True, blank=True, db_index=True, editable=False)
+    updated   = models.DateTimeField(auto_now=True, db_index=True)
     #extras    = models.TextField(blank=True)
 
     objects   = TravelEntityManager()
@@ -280,6 +408,7 @@ class TravelEntity(models.Model):
     class Meta:
         ordering = ('name',)
         db_table = 'travel_entity'
+        index_together = (('name', 'id'),)
     
     #===========================================================================
     class Related:
@@ -346,29 +475,19 @@ class TravelEntity(models.Model):
     #---------------------------------------------------------------------------
     @cached_property
     def category_detail(self):
-        kind = self.type
-        if kind.abbr == 'wh':
-            return WORLD_HERITAGE_CATEGORY.get(self.category, 'Unknown')
-
-        elif kind.abbr == 'st':
-            return SUBNATIONAL_CATEGORY.get(self.category, kind.title)
-        
-        return kind.title
+        return category_detail(self.type.abbr, self.category, self.type.title)
     
     #---------------------------------------------------------------------------
     @cached_property
     def timezone(self):
-        return (
-               self.tz
-            or (self.state and self.state.timezone)
-            or (self.country and self.country.timezone)
-            or 'UTC'
-        )
+        if self.tz or self.id is None:
+            return self.tz or 'UTC'
+        return TravelEntity.objects.timezones([self.id]).get(self.id, 'UTC')
     
     #---------------------------------------------------------------------------
     @property
     def tzinfo(self):
-        return pytz.timezone(self.timezone)
+        return travel_utils.get_tzinfo(self.timezone)
     
     #---------------------------------------------------------------------------
     def get_continent(self):
@@ -377,32 +496,19 @@ class TravelEntity(models.Model):
         return self.country.continent if self.country else None
     
     #---------------------------------------------------------------------------
-    @property
+    @cached_property
     def relationships(self):
-        abbr = self.type.abbr
-        qs = None
-        if abbr == 'cn':
-            qs = TravelEntityType.objects.distinct().filter(
-                models.Q(entity_set__continent=self) |
-                models.Q(entity_set__country__continent=self)
-            )
-        else:
-            key = self.Related.ENTITY_TYPES.get(abbr)
-            qs = TravelEntityType.objects.distinct().filter(**{key: self})
-        
-        if qs:
-            return qs.annotate(cnt=models.Count('abbr')).values_list('abbr', 'cnt')
-
-        return ()
+        return TravelEntity.objects.relationship_counts([self])[self.id]
 
     #---------------------------------------------------------------------------
-    @property
+    @cached_property
     def related_entities(self):
+        url = self.get_absolute_url()
         return [{
             'abbr': abbr,
             'text': self.Related.DETAILS[abbr],
             'count': cnt,
-            'url': reverse('travel-entity-relationships', args=[self.type.abbr, self.code_url_bit, abbr]),
+            'url': '{}{}/'.format(url, abbr),
         } for abbr, cnt in self.relationships]
         
     #---------------------------------------------------------------------------
@@ -423,14 +529,49 @@ class TravelEntity(models.Model):
         return TravelEntity.objects.filter(**{key: self, 'type': type})
         
     #---------------------------------------------------------------------------
-    def update_flag(self, flag_url):
-        flag = self.flag if self.flag and not self.flag.is_locked else TravelFlag()
+    def update_flag(self, flag_url, flag=None):
+        if flag is None:
+            flag = self.flag if self.flag and not self.flag.is_locked else TravelFlag()
         svg, thumb, large = travel_utils.get_flag_data(flag_url)
         flag.update(flag_url, self.flag_dir, self.code, svg, thumb, large)
         self.flag = flag
         self.save()
+        _invalidate_flag_game()
         return flag
 
+    #---------------------------------------------------------------------------
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(TravelEntity, cls).from_db(db, field_names, values)
+        # only from loaded fields; touching deferred ones would query for each
+        loaded = set(field_names)
+        if loaded.issuperset(('country_id', 'state_id', 'continent_id')):
+            instance._loaded_parents = instance.parent_ids
+        if loaded.issuperset(('tz', 'state_id', 'country_id')):
+            instance._loaded_tz = (instance.tz, instance.state_id, instance.country_id)
+        if 'type_id' in loaded:
+            instance._loaded_type_id = instance.type_id
+        return instance
+
+    #---------------------------------------------------------------------------
+    @property
+    def parent_ids(self):
+        return set([self.country_id, self.state_id, self.continent_id])
+
+    #---------------------------------------------------------------------------
+    def save(self, *args, **kws):
+        self.geocell = travel_utils.geocell(self.lat, self.lon)
+        return super(TravelEntity, self).save(*args, **kws)
+
+    #---------------------------------------------------------------------------
+    @cached_property
+    def nearby(self):
+        if self.lat is None or self.lon is None:
+            return []
+
+        places = TravelEntity.objects.within_radius(self.lat, self.lon, NEARBY_KM)
+        return [e for e in places if e.id != self.id][:NEARBY_LIMIT]
+
     #---------------------------------------------------------------------------
     @property
     def lower(self):
@@ -445,6 +586,82 @@ class TravelEntity(models.Model):
             return GOOGLE_MAPS.format(travel_utils.nice_url(self.name),)
 
 
+#===============================================================================
+class TravelSearchToken(models.Model):
+    entity = models.ForeignKey(TravelEntity, related_name='search_tokens')
+    token  = models.CharField(max_length=8)
+
+    objects = TravelSearchTokenManager()
+
+    #===========================================================================
+    class Meta:
+        db_table = 'travel_search_token'
+        unique_together = ('token', 'entity')
+
+
+#-------------------------------------------------------------------------------
+def index_entity(sender, instance, raw=False, **kws):
+    if not raw:
+        TravelSearchToken.objects.index([instance])
+
+
+#-------------------------------------------------------------------------------
+def country_changed(sender, instance, raw=False, **kws):
+    if not raw and instance.type.abbr == 'co':
+        _invalidate_flag_game()
+
+
+#-------------------------------------------------------------------------------
+def entity_timezone_changed(sender, instance, raw=False, **kws):
+    if raw:
+        return
+
+    current = (instance.tz, instance.state_id, instance.country_id)
+    if not kws.get('created') and getattr(instance, '_loaded_tz', None) != current:
+        TravelEntity.objects.invalidate_timezones([instance.id])
+
+    instance._loaded_tz = current
+
+
+#-------------------------------------------------------------------------------
+def entity_listing_changed(sender, instance, raw=False, **kws):
+    if raw:
+        return
+
+    abbrs = [instance.type.abbr]
+    loaded_type_id = getattr(instance, '_loaded_type_id', None)
+    if loaded_type_id and loaded_type_id != instance.type_id:
+        # moved out of another type's listing
+        abbrs.extend(TravelEntityType.objects.filter(id=loaded_type_id).values_list('abbr', flat=True))
+
+    travel_listing.invalidate_listing(*abbrs)
+    instance._loaded_type_id = instance.type_id
+
+
+#-------------------------------------------------------------------------------
+def entity_relationships_changed(sender, instance, raw=False, **kws):
+    if raw:
+        return
+
+    ids = instance.parent_ids | getattr(instance, '_loaded_parents', set())
+    ids.discard(None)
+    # continents relate to entities through their country's continent as well
+    ids.update(TravelEntity.objects.filter(id__in=ids).values_list('continent', flat=True))
+    ids.add(instance.id)
+    TravelEntity.objects.invalidate_relationships(ids)
+    instance._loaded_parents = instance.parent_ids
+
+
+models.signals.post_save.connect(index_entity, sender=TravelEntity)
+models.signals.post_save.connect(entity_listing_changed, sender=TravelEntity)
+models.signals.post_delete.connect(entity_listing_changed, sender=TravelEntity)
+models.signals.post_save.connect(country_changed, sender=TravelEntity)
+models.signals.post_delete.connect(country_changed, sender=TravelEntity)
+models.signals.post_save.connect(entity_relationships_changed, sender=TravelEntity)
+models.signals.post_delete.connect(entity_relationships_changed, sender=TravelEntity)
+models.signals.post_save.connect(entity_timezone_changed, sender=TravelEntity)
+
+
 #===============================================================================
 @python_2_unicode_compatible
 class TravelLog(models.Model):
@@ -456,6 +673,10 @@ class TravelLog(models.Model):
         (4, mark_safe(STAR * 2)),
         (5, mark_safe(STAR * 1)),
     )
+
+    # Formats of ``history_json``: 1 is a list of objects per entity and log;
+    # 2 is columnar, see ``history_columns``
+    HISTORY_VERSIONS = (1, 2)
     
     arrival = models.DateTimeField()
     rating = models.PositiveSmallIntegerField(choices=RATING_CHOICES, default=3)
@@ -469,6 +690,12 @@ class TravelLog(models.Model):
     class Meta:
         get_latest_by = 'arrival'
         ordering = ('-arrival',)
+        # a user's logs of an entity, and a user's whole history, newest first;
+        # see the check_query_plans command
+        index_together = (
+            ('user', 'entity', 'arrival'),
+            ('user', 'arrival', 'entity', 'rating'),
+        )
 
     #---------------------------------------------------------------------------
     def __str__(self):
@@ -483,6 +710,13 @@ class TravelLog(models.Model):
     def get_absolute_url(self):
         return reverse('travel-log-entry', args=[self.user.username, self.id])
     
+    #---------------------------------------------------------------------------
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(TravelLog, cls).from_db(db, field_names, values)
+        instance._loaded_pair = (instance.user_id, instance.entity_id)
+        return instance
+    
     #---------------------------------------------------------------------------
     def save(self, *args, **kws):
         if not self.arrival:
@@ -500,8 +734,7 @@ class TravelLog(models.Model):
     def user_history(cls, user):
         return (
             TravelEntity.objects.filter(travellog__user=user).distinct().values(
-                'id', 'code', 'name', 'locality', 'country__name', 'country__code',
-                'country__flag__thumb', 'type__abbr', 'flag__thumb'
+                *HISTORY_ENTITY_FIELDS
             ),
             TravelLog.objects.filter(user=user).order_by('-arrival').values(
                 'id', 'arrival', 'entity__id', 'rating'
@@ -510,14 +743,77 @@ class TravelLog(models.Model):
 
     #---------------------------------------------------------------------------
     @classmethod
-    def history_json(cls, user):
+    def history_columns(cls, user):
+        '''
+        The user's history as parallel arrays per field. Log arrivals are
+        epoch seconds, and each log refers to its entity by row index into
+        the interned entity table.
+        '''
         entities, logs = cls.user_history(user)
-        return travel_utils.json_dumps({
+        table = OrderedDict((key, []) for key in HISTORY_ENTITY_FIELDS)
+        rows = {}
+        for row, entity in enumerate(entities):
+            rows[entity['id']] = row
+            for key, column in table.items():
+                column.append(entity[key])
+
+        columns = OrderedDict((key, []) for key in ('id', 'arrival', 'entity', 'rating'))
+        for log in logs:
+            columns['id'].append(log['id'])
+            columns['arrival'].append(calendar.timegm(log['arrival'].utctimetuple()))
+            columns['entity'].append(rows[log['entity__id']])
+            columns['rating'].append(log['rating'])
+
+        return {'version': 2, 'entities': table, 'logs': columns}
+
+    #---------------------------------------------------------------------------
+    @classmethod
+    def history_json(cls, user, version=1):
+        if version == 2:
+            return json.dumps(cls.history_columns(user), separators=(',', ':'))
+
+        entities, logs = cls.user_history(user)
+        return travel_utils.fast_json_dumps({
             'entities': list(entities),
             'logs': list(logs)
         })
 
 
+#===============================================================================
+class TravelLogSummary(models.Model):
+    user          = models.ForeignKey(User, related_name='travel_summaries')
+    entity        = models.ForeignKey(TravelEntity, related_name='+')
+    count         = models.PositiveIntegerField(default=0)
+    first_arrival = models.DateTimeField()
+    last_arrival  = models.DateTimeField()
+
+    objects = TravelLogSummaryManager()
+
+    #===========================================================================
+    class Meta:
+        db_table = 'travel_log_summary'
+        unique_together = ('user', 'entity')
+
+
+#-------------------------------------------------------------------------------
+def travel_log_changed(sender, instance, **kws):
+    pairs = set([(instance.user_id, instance.entity_id)])
+    loaded = getattr(instance, '_loaded_pair', None)
+    if loaded:
+        pairs.add(loaded)
+
+    for user_id, entity_id in pairs:
+        TravelLogSummary.objects.refresh(TravelLog.objects, user_id, entity_id)
+        TravelLog.objects.invalidate_checklist(user_id)
+        TravelLog.objects.invalidate_history(user_id)
+
+    instance._loaded_pair = (instance.user_id, instance.entity_id)
+
+
+models.signals.post_save.connect(travel_log_changed, sender=TravelLog)
+models.signals.post_delete.connect(travel_log_changed, sender=TravelLog)
+
+
 #===============================================================================
 @python_2_unicode_compatible
 class TravelLanguage(models.Model):
@@ -627,3 +923,10 @@ class TravelEntityInfo(models.Model):
         return EntityImage(self.entity, 'map')
 
 
+#-------------------------------------------------------------------------------
+def entity_info_changed(sender, instance, raw=False, **kws):
+    if not raw:
+        travel_listing.invalidate_listing(instance.entity.type.abbr)
+
+
+models.signals.post_save.connect(entity_info_changed, sender=TravelEntityInfo)
@@ -0,0 +1,231 @@
+'''
+Optional per-view instrumentation of the ``travel`` views: SQL query count,
+database time, template render time, total time and response size.
+
+To enable, set ``TRAVEL_PROFILE_VIEWS = True`` and add
+``'travel.profiling.ProfilingMiddleware'`` to ``MIDDLEWARE_CLASSES``. Each
+measurement is added to histograms in the cache, shared by every process,
+which the ``profile_views`` command prints. Responses also get a
+``Server-Timing`` header, so the numbers show in the browser's dev tools.
+'''
+import time
+import itertools
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+PROFILE_CACHE_KEY = 'travel:profile'
+
+MILLISECONDS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# Upper bounds of each histogram's buckets; a final bucket takes the rest
+HISTOGRAM_BOUNDS = (
+    ('queries', (1, 2, 5, 10, 20, 50, 100, 200, 500)),
+    ('db_ms', MILLISECONDS),
+    ('template_ms', MILLISECONDS),
+    ('total_ms', MILLISECONDS),
+    ('size_kb', (1, 5, 10, 50, 100, 500, 1000)),
+)
+
+METRICS = tuple(metric for metric, bounds in HISTOGRAM_BOUNDS)
+
+
+#-------------------------------------------------------------------------------
+def is_enabled():
+    return getattr(settings, 'TRAVEL_PROFILE_VIEWS', False)
+
+
+#-------------------------------------------------------------------------------
+@contextmanager
+def timing(request, name):
+    '''
+    Add the time spent in the ``with`` block to ``request``'s timings, if the
+    request is being profiled.
+    '''
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings = getattr(request, '_travel_timings', None)
+        if timings is not None:
+            timings[name] = timings.get(name, 0) + (time.time() - start) * 1000
+
+
+#-------------------------------------------------------------------------------
+def _key(*bits):
+    return ':'.join((PROFILE_CACHE_KEY,) + tuple(str(bit) for bit in bits))
+
+
+#-------------------------------------------------------------------------------
+def _incr(key, delta=1):
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        if cache.add(key, delta, None):
+            return delta
+        return cache.incr(key, delta)
+
+
+#-------------------------------------------------------------------------------
+def bucket(bounds, value):
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            return i
+    return len(bounds)
+
+
+#-------------------------------------------------------------------------------
+def _view_keys(view):
+    keys = [_key(view, 'count')]
+    for metric, bounds in HISTOGRAM_BOUNDS:
+        keys.extend(_key(view, metric, i) for i in range(len(bounds) + 1))
+        keys.extend([_key(view, metric, 'n'), _key(view, metric, 'sum')])
+    return keys
+
+
+#-------------------------------------------------------------------------------
+def _register(view):
+    # the first process to record a view adds it to a numbered list, with
+    # atomic cache operations only, so that concurrent processes can't lose it
+    if cache.add(_key('view', view), True, None):
+        cache.set(_key('views', _incr(_key('views'))), view, None)
+
+
+#-------------------------------------------------------------------------------
+def _registry_keys():
+    count = cache.get(_key('views')) or 0
+    return [_key('views', i) for i in range(1, count + 1)]
+
+
+#-------------------------------------------------------------------------------
+def views():
+    return sorted(set(cache.get_many(_registry_keys()).values()))
+
+
+#-------------------------------------------------------------------------------
+def record(view, measurements):
+    '''
+    Count one request to ``view`` in the histogram of each metric in the
+    ``measurements`` dict. Sums are kept in thousandths, for the means.
+    '''
+    _register(view)
+    _incr(_key(view, 'count'))
+    for metric, bounds in HISTOGRAM_BOUNDS:
+        value = measurements.get(metric)
+        if value is not None:
+            _incr(_key(view, metric, bucket(bounds, value)))
+            _incr(_key(view, metric, 'n'))
+            _incr(_key(view, metric, 'sum'), int(value * 1000))
+
+
+#-------------------------------------------------------------------------------
+def _percentile(bounds, counts, n, fraction):
+    total = 0
+    for i, count in enumerate(counts):
+        total += count
+        if total >= n * fraction:
+            return bounds[i] if i < len(bounds) else float('inf')
+
+
+#-------------------------------------------------------------------------------
+def histograms(view):
+    '''
+    ``view``'s request count and, for each metric measured, a dict of its
+    ``n``, ``mean``, ``p50`` and ``p95`` (as bucket upper bounds) and bucket
+    ``counts``.
+    '''
+    values = cache.get_many(_view_keys(view))
+    results = {}
+    for metric, bounds in HISTOGRAM_BOUNDS:
+        n = values.get(_key(view, metric, 'n'), 0)
+        if not n:
+            continue
+
+        counts = [values.get(_key(view, metric, i), 0) for i in range(len(bounds) + 1)]
+        results[metric] = {
+            'n': n,
+            'mean': values.get(_key(view, metric, 'sum'), 0) / 1000.0 / n,
+            'p50': _percentile(bounds, counts, n, 0.5),
+            'p95': _percentile(bounds, counts, n, 0.95),
+            'counts': counts,
+        }
+    return values.get(_key(view, 'count'), 0), results
+
+
+#-------------------------------------------------------------------------------
+def reset():
+    keys = _registry_keys() + [_key('views')]
+    for view in views():
+        keys.append(_key('view', view))
+        keys.extend(_view_keys(view))
+    cache.delete_many(keys)
+
+
+#-------------------------------------------------------------------------------
+def server_timing(measurements):
+    return ', '.join(
+        '{};dur={:.1f}{}'.format(name, measurements[metric], desc)
+        for name, metric, desc in (
+            ('db', 'db_ms', ';desc="{} queries"'.format(measurements['queries'])),
+            ('template', 'template_ms', ''),
+            ('total', 'total_ms', ''),
+        )
+        if measurements.get(metric) is not None
+    )
+
+
+#===============================================================================
+class ProfilingMiddleware(object):
+    '''
+    Measures the views of the ``travel`` app only, and records only their
+    successful responses: error pages would skew the histograms of exactly
+    the views under investigation. Queries are read from the connection's
+    query log, which is kept for profiled requests even when ``DEBUG`` is
+    off. Streaming responses run most of their queries after the middleware
+    is done, so only the view itself is measured for them.
+    '''
+
+    #---------------------------------------------------------------------------
+    def __init__(self):
+        if not is_enabled():
+            raise MiddlewareNotUsed
+
+    #---------------------------------------------------------------------------
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not view_func.__module__.startswith('travel.'):
+            return None
+
+        request._travel_profile = (
+            '{}.{}'.format(view_func.__module__, view_func.__name__),
+            time.time(),
+            len(connection.queries_log),
+            connection.force_debug_cursor
+        )
+        request._travel_timings = {}
+        connection.force_debug_cursor = True
+        return None
+
+    #---------------------------------------------------------------------------
+    def process_response(self, request, response):
+        profile = getattr(request, '_travel_profile', None)
+        if profile is None:
+            return response
+
+        view, start, logged, force_debug_cursor = profile
+        connection.force_debug_cursor = force_debug_cursor
+        queries = list(itertools.islice(connection.queries_log, logged, None))
+        measurements = {
+            'queries': len(queries),
+            'db_ms': sum(float(query['time']) for query in queries) * 1000,
+            'template_ms': request._travel_timings.get('template'),
+            'total_ms': (time.time() - start) * 1000,
+        }
+        if not response.streaming:
+            measurements['size_kb'] = len(response.content) / 1024.0
+
+        if response.status_code < 400:
+            record(view, measurements)
+        response['Server-Timing'] = server_timing(measurements)
+        return response
@@ -0,0 +1,216 @@
+'''
+Pluggable search backends for ``TravelEntityManager.search`` and
+``TravelEntityManager.advanced_search``.
+
+The backend is selected with the ``TRAVEL_SEARCH_BACKEND`` setting, which
+should be a dotted path to a ``BaseSearchBackend`` subclass.
+'''
+import operator
+from collections import OrderedDict, defaultdict
+from django.conf import settings
+from django.db.models import Q, Count, Case, When, Value, IntegerField
+from django.utils.module_loading import import_string
+
+NGRAM_SIZE = 3
+CODE_TOKEN = '#{}'
+SEARCH_FIELDS = ('name', 'full_name', 'locality')
+DEFAULT_SEARCH_BACKEND = 'travel.search.IndexSearchBackend'
+BATCH_LINE_LIMIT = 25
+
+_backend = None
+
+
+#-------------------------------------------------------------------------------
+def ngrams(text, size=NGRAM_SIZE):
+    text = (text or '').lower()
+    return set(text[i:i + size] for i in range(len(text) - size + 1))
+
+
+#-------------------------------------------------------------------------------
+def term_tokens(term):
+    return ngrams(term)
+
+
+#-------------------------------------------------------------------------------
+def entity_tokens(entity):
+    '''
+    All the index tokens for ``entity``: the n-grams of each searchable
+    text field, plus a single token for an exact code match.
+    '''
+    tokens = set()
+    for attr in SEARCH_FIELDS:
+        tokens.update(ngrams(getattr(entity, attr)))
+
+    if entity.code:
+        tokens.add(CODE_TOKEN.format(entity.code.lower()))
+
+    return tokens
+
+
+#-------------------------------------------------------------------------------
+def search_q(term):
+    return (
+        Q(name__icontains=term)      |
+        Q(full_name__icontains=term) |
+        Q(locality__icontains=term)  |
+        Q(code__iexact=term)
+    )
+
+
+#-------------------------------------------------------------------------------
+def get_search_backend():
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'TRAVEL_SEARCH_BACKEND', DEFAULT_SEARCH_BACKEND)
+        _backend = import_string(path)()
+    return _backend
+
+
+#===============================================================================
+class BaseSearchBackend(object):
+
+    #---------------------------------------------------------------------------
+    def filter(self, qs, term):
+        raise NotImplementedError
+
+    #---------------------------------------------------------------------------
+    def rank(self, qs, term):
+        return qs
+
+    #---------------------------------------------------------------------------
+    def search(self, qs, term, type=None):
+        term = term.strip() if term else term
+        if term:
+            qs = self.rank(self.filter(qs, term), term)
+        elif not type:
+            return qs.none()
+
+        return qs.filter(type__abbr=type) if type else qs
+
+    #---------------------------------------------------------------------------
+    def advanced_search(self, qs, bits, type=None):
+        qq = reduce(operator.ior, [self.filter_q(term) for term in bits])
+        qs = qs.filter(qq)
+        return qs.filter(type__abbr=type) if type else qs
+
+    #---------------------------------------------------------------------------
+    def filter_q(self, term):
+        raise NotImplementedError
+
+    #---------------------------------------------------------------------------
+    def exact_q(self, lines):
+        codes = set(lines) | set(line.upper() for line in lines)
+        names = set(lines) | set(line.title() for line in lines)
+        return Q(code__in=codes) | Q(name__in=names)
+
+    #---------------------------------------------------------------------------
+    def batch_search(self, qs, lines, type=None, limit=BATCH_LINE_LIMIT):
+        '''
+        Resolve each line separately, returning a list of ``(line, entities)``
+        in input order. Exact code and name hits for every line are fetched
+        together in a single query, then case-insensitive name hits for the
+        lines left without one; only the lines still without a hit fall back
+        to an individual, ``limit``-bounded fuzzy search.
+        '''
+        lines = list(OrderedDict.fromkeys(line for line in lines if line))
+        if type:
+            qs = qs.filter(type__abbr=type)
+
+        matches = OrderedDict((line, []) for line in lines)
+        if not lines:
+            return matches.items()
+
+        # lines differing only in case are still resolved separately
+        keys = defaultdict(list)
+        for line in lines:
+            keys[line.lower()].append(line)
+
+        def add_matches(entities):
+            for entity in entities:
+                for key in set([entity.code.lower(), entity.name.lower()]):
+                    for line in keys.get(key, ()):
+                        found = matches[line]
+                        if len(found) < limit and entity not in found:
+                            found.append(entity)
+
+        add_matches(qs.filter(self.exact_q(lines)))
+        missing = [line for line, found in matches.items() if not found]
+        if missing:
+            add_matches(qs.filter(reduce(operator.ior, [Q(name__iexact=line) for line in missing])))
+
+        for line, found in matches.items():
+            if not found:
+                found.extend(self.rank(self.filter(qs, line), line)[:limit])
+
+        return matches.items()
+
+
+#===============================================================================
+class QuerySearchBackend(BaseSearchBackend):
+    '''
+    The original behavior: ``icontains`` across the text fields, which scans
+    the entire ``travel_entity`` table.
+    '''
+
+    #---------------------------------------------------------------------------
+    def filter_q(self, term):
+        return search_q(term)
+
+    #---------------------------------------------------------------------------
+    def filter(self, qs, term):
+        return qs.filter(self.filter_q(term))
+
+
+#===============================================================================
+class IndexSearchBackend(QuerySearchBackend):
+    '''
+    Narrows the candidate entities through the ``TravelSearchToken`` n-gram
+    index, then applies the original filter to only those candidates, so the
+    results are identical to ``QuerySearchBackend`` but ordered by relevance.
+
+    Terms shorter than ``NGRAM_SIZE`` have no n-grams and fall back to the
+    plain query, so that they still match names containing them as well as
+    codes.
+    '''
+
+    #---------------------------------------------------------------------------
+    def code_q(self, term):
+        from travel.models import TravelSearchToken
+        return Q(id__in=TravelSearchToken.objects.filter(
+            token=CODE_TOKEN.format(term.lower())
+        ).values('entity'))
+
+    #---------------------------------------------------------------------------
+    def candidates(self, term):
+        from travel.models import TravelSearchToken
+        tokens = term_tokens(term)
+        matches = TravelSearchToken.objects.filter(token__in=tokens).values('entity')
+        matches = matches.annotate(hits=Count('token')).filter(hits=len(tokens))
+        return Q(id__in=matches.values('entity')) | self.code_q(term)
+
+    #---------------------------------------------------------------------------
+    def exact_q(self, lines):
+        from travel.models import TravelSearchToken
+        code_matches = TravelSearchToken.objects.filter(
+            token__in=[CODE_TOKEN.format(line.lower()) for line in lines]
+        ).values('entity')
+        names = set(lines) | set(line.title() for line in lines)
+        return Q(id__in=code_matches) | Q(name__in=names)
+
+    #---------------------------------------------------------------------------
+    def filter_q(self, term):
+        q = search_q(term)
+        if len(term) < NGRAM_SIZE:
+            return q
+        return self.candidates(term) & q
+
+    #---------------------------------------------------------------------------
+    def rank(self, qs, term):
+        return qs.annotate(relevance=Case(
+            When(code__iexact=term, then=Value(0)),
+            When(name__iexact=term, then=Value(1)),
+            When(name__istartswith=term, then=Value(2)),
+            When(name__icontains=term, then=Value(3)),
+            default=Value(4),
+            output_field=IntegerField()
+        )).order_by('relevance', 'name')
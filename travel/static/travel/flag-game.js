@@ -99,6 +99,13 @@
                 views.group_view(groups.next());
             });
             views.group_view(groups.next());
+        },
+        
+        load: function(url) {
+            var game = this;
+            $.getJSON(url, function(data) {
+                game.play(data.countries, data.groups);
+            });
         }
     };
 }(this, jQuery));
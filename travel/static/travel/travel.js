@@ -393,6 +393,34 @@
         console.log('delta', new Date() - start);
     };
     
+    //--------------------------------------------------------------------------
+    var expandColumns = function(columns) {
+        var keys = iterKeys(columns);
+        var count = keys.length ? columns[keys[0]].length : 0;
+        var rows = [];
+        for(var i = 0; i < count; i++) {
+            var row = {};
+            keys.forEach(function(key) { row[key] = columns[key][i]; });
+            rows.push(row);
+        }
+        return rows;
+    };
+    
+    //--------------------------------------------------------------------------
+    // Expand the columnar (version 2) history format into the entity and log
+    // objects the controller expects
+    //--------------------------------------------------------------------------
+    var expandHistory = function(history) {
+        var entities = expandColumns(history.entities);
+        var logs = expandColumns(history.logs).map(function(log) {
+            log.entity__id = entities[log.entity].id;
+            log.arrival = moment.unix(log.arrival);
+            delete log.entity;
+            return log;
+        });
+        return {'entities': entities, 'logs': logs};
+    };
+    
     //--------------------------------------------------------------------------
     var controller = (function() {
         var entityDict = {};
@@ -417,7 +445,9 @@
                         console.log(log);
                     }
                     log.entity.logs.push(log);
-                    log.arrival = moment(log.arrival.value);
+                    if(!moment.isMoment(log.arrival)) {
+                        log.arrival = moment(log.arrival.value);
+                    }
                     years.add(log.arrival.year());
                     summary.add(log.entity);
                     return log;
@@ -658,6 +688,15 @@
         controller: controller,
         profileHistory: function(entities, logs, conf) {
             controller.initialize(entities, logs, conf);
+        },
+        loadProfileHistory: function(url, conf) {
+            var xhr = new XMLHttpRequest();
+            xhr.open('GET', url);
+            xhr.onload = function() {
+                var history = expandHistory(JSON.parse(xhr.responseText));
+                controller.initialize(history.entities, history.logs, conf);
+            };
+            xhr.send();
         }
     };
 }(window));
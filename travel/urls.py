@@ -6,12 +6,15 @@ from travel.extras import flag_game
 search_patterns = [
     url(r'^$',          views.search, name='travel-search'),
     url(r'^advanced/$', views.search_advanced, name='travel-search-advanced'),
+    url(r'^json/$',     views.search_json, name='travel-search-json'),
 ]
 
 item_patterns = [
     url(r'^$',                                 views.by_locale, name='travel-by-locale'),
+    url(r'^json/$',                            views.by_locale_json, name='travel-by-locale-json'),
     url(r'^(?P<code>\w+)(?:-(?P<aux>\w+))?/$', views.entity, name='travel-entity'),
     url(r'^(?P<code>\w+)(?:-(?P<aux>\w+))?/(?P<rel>\w+)/$', views.entity_relationships, name='travel-entity-relationships'),
+    url(r'^(?P<code>\w+)(?:-(?P<aux>\w+))?/(?P<rel>\w+)/json/$', views.entity_relationships_json, name='travel-entity-relationships-json'),
 ]
 
 add_patterns = [
@@ -23,6 +26,7 @@ add_patterns = [
 profile_patterns = [
     url(r'^$',                   views.all_profiles, name='travel-profiles'),
     url(r'^([^/]+)/$',           views.profile, name='travel-profile'),
+    url(r'^([^/]+)/history/$',   views.profile_history_json, name='travel-profile-history'),
     url(r'^([^/]+)/log/(\d+)/$', views.log_entry, name='travel-log-entry'),
 ]
 
@@ -30,11 +34,13 @@ bucket_list_patterns = [
     url(r'^$',               views.bucket_lists, name='travel-buckets'),
     url(r'^(\d+)/$',         views.bucket_list, name='travel-bucket'),
     url(r'^(\d+)/([^/]+)/$', views.bucket_list_for_user, name='travel-bucket-for_user'),
+    url(r'^(\d+)/json/(.+)/$', views.bucket_list_comparison_json, name='travel-bucket-compare-json'),
     url(r'^(\d+)/(.+)/$',    views.bucket_list_comparison, name='travel-bucket-for_user'),
 ]
 
 quiz_patterns = [
     url(r'^flags/$', flag_game.flag_game, name='travel-flag-quiz'),
+    url(r'^flags/data/$', flag_game.flag_game_data, name='travel-flag-quiz-data'),
 ]
 
 language_patterns = [
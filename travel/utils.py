@@ -1,17 +1,28 @@
 # -*- coding:utf8 -*-
 import io
 import re
+import math
 import json
 import datetime
 from urllib import quote_plus
 from decimal import Decimal, localcontext
+from multiprocessing.pool import ThreadPool
+import pytz
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from PIL import Image
 from dateutil import parser as dt_parser
 
 
 DEFAULT_FLAG_SIZES = (32, 128)
 
+# (connect, read) timeouts in seconds, and retries for failed connections and
+# 5xx responses, when fetching flag images
+FETCH_TIMEOUT = (3.05, 15)
+FETCH_RETRIES = 3
+FETCH_WORKERS = 4
+
 # from django.db import connection
 # #-------------------------------------------------------------------------------
 # def custom_sql_as_dict(sql, args):
@@ -47,10 +58,67 @@ def nice_url(text):
     return quote_plus(text.encode('utf8'))
 
 
+#===============================================================================
+class UrlFetcher(object):
+    '''
+    Downloads over a pooled, retrying ``requests`` session, several URLs at a
+    time. Pass a ``session`` (for instance one with a local stand-in adapter
+    mounted) to fetch from somewhere other than the network.
+    '''
+
+    #---------------------------------------------------------------------------
+    def __init__(self, session=None, timeout=FETCH_TIMEOUT, retries=FETCH_RETRIES, workers=FETCH_WORKERS):
+        self.timeout = timeout
+        self.workers = workers
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_maxsize=workers,
+                max_retries=Retry(
+                    total=retries,
+                    backoff_factor=0.5,
+                    status_forcelist=(500, 502, 503, 504),
+                    # once retries run out, return the error response as before
+                    raise_on_status=False
+                )
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+    #---------------------------------------------------------------------------
+    def get_response(self, url, headers=None):
+        return self.session.get(url, headers=headers, timeout=self.timeout)
+
+    #---------------------------------------------------------------------------
+    def get(self, url):
+        r = self.get_response(url)
+        return r.content if r.ok else None
+
+    #---------------------------------------------------------------------------
+    def map(self, func, items):
+        items = list(items)
+        if len(items) < 2:
+            return [func(item) for item in items]
+
+        pool = ThreadPool(min(self.workers, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+
+    #---------------------------------------------------------------------------
+    def get_many(self, urls):
+        return self.map(self.get, urls)
+
+
+# Replace with a ``UrlFetcher`` over another session to stand in for the network
+url_fetcher = UrlFetcher()
+
+
 #-------------------------------------------------------------------------------
 def get_url_content(url):
-    r = requests.get(url)
-    return r.content if r.ok else None
+    return url_fetcher.get(url)
 
 
 #-------------------------------------------------------------------------------
@@ -67,7 +135,12 @@ def get_wiki_flags_from_svg(url):
     
     http://upload.wikimedia.org/wikipedia/commons/thumb/x/yz/Flag_of_XYZ.svg/120px-Flag_of_XYZ.svg.png
     '''
-    data = [get_url_content(url)]
+    return url_fetcher.get_many([url] + wiki_thumbnail_urls(url))
+
+
+#-------------------------------------------------------------------------------
+def wiki_thumbnail_urls(url):
+    urls = []
     for size in DEFAULT_FLAG_SIZES:
         pth, base = url.rsplit('/', 1)
         size_url = '{}/{}/{}px-{}.png'.format(
@@ -77,15 +150,19 @@ def get_wiki_flags_from_svg(url):
             base
         )
         
-        data.append(get_url_content(size_url))
+        urls.append(size_url)
 
-    return data
+    return urls
+
+
+#-------------------------------------------------------------------------------
+def is_svg_url(url):
+    return url.lower().endswith('.svg')
 
 
 #-------------------------------------------------------------------------------
 def get_flag_data(url):
-    norm_url = url.lower()
-    if norm_url.endswith('.svg'):
+    if is_svg_url(url):
         svg, thumb, large = get_wiki_flags_from_svg(url)
         return svg, thumb, large
     else:
@@ -95,19 +172,35 @@ def get_flag_data(url):
 
 #-------------------------------------------------------------------------------
 def get_flags_from_image_by_size(url):
-    im = Image.open(io.BytesIO(get_url_content(url)))
-    x1, y1 = size = im.size
-    resize = make_resizer(size)
-    data = []
-    for x1 in DEFAULT_FLAG_SIZES:
-        x2, y2 = new_size = resize(x1)
-        resample = Image.BICUBIC if x2 > x1 else Image.ANTIALIAS
-        stream = io.BytesIO()
-        new_im = im.resize(new_size, resample)
-        new_im.save(stream, 'PNG')
-        data.append(stream.getvalue())
+    return resize_flag_image(get_url_content(url))
+
+
+#-------------------------------------------------------------------------------
+def open_image(data):
+    im = Image.open(io.BytesIO(data))
+    im.load()
+    return im
+
+
+#-------------------------------------------------------------------------------
+def resize_image(im, width):
+    x1, y1 = im.size
+    x2, y2 = new_size = make_resizer(im.size)(width)
+    resample = Image.BICUBIC if x2 > x1 else Image.ANTIALIAS
+    stream = io.BytesIO()
+    new_im = im.resize(new_size, resample)
+    new_im.save(stream, 'PNG')
+    return stream.getvalue()
 
-    return data
+
+#-------------------------------------------------------------------------------
+def resize_flag_image(data):
+    '''
+    PNGs of each of ``DEFAULT_FLAG_SIZES`` from image ``data``; a plain
+    function of bytes, so it can run in a process pool.
+    '''
+    im = open_image(data)
+    return [resize_image(im, width) for width in DEFAULT_FLAG_SIZES]
 
 
 latlon_sym_re = re.compile(
@@ -163,6 +256,102 @@ def parse_latlon(s):
     raise ValueError('Invalid Lat/Lon value: %s' % (s,))
 
 
+# mean earth radius, in kilometres
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+GEOCELL_DEGREES = 0.5
+GEOCELL_ROWS = int(180 / GEOCELL_DEGREES)
+GEOCELL_COLS = int(360 / GEOCELL_DEGREES)
+
+#-------------------------------------------------------------------------------
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = [math.radians(float(d)) for d in (lat1, lon1, lat2, lon2)]
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2 +
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1, math.sqrt(a)))
+
+
+#-------------------------------------------------------------------------------
+def _geocell_row(lat):
+    return min(GEOCELL_ROWS - 1, max(0, int((float(lat) + 90) // GEOCELL_DEGREES)))
+
+
+#-------------------------------------------------------------------------------
+def _geocell_col(lon):
+    return int((float(lon) + 180) // GEOCELL_DEGREES) % GEOCELL_COLS
+
+
+#-------------------------------------------------------------------------------
+def geocell(lat, lon):
+    '''
+    Grid cell number for a coordinate: cells are ``GEOCELL_DEGREES`` square
+    and numbered row by row from the south west, so each row of cells is a
+    contiguous range of numbers.
+    '''
+    if lat is None or lon is None:
+        return None
+    return _geocell_row(lat) * GEOCELL_COLS + _geocell_col(lon)
+
+
+#-------------------------------------------------------------------------------
+def geocell_ranges(south, west, north, east):
+    '''
+    Inclusive ``(first, last)`` geocell ranges covering a bounding box. A box
+    with ``west > east`` crosses the antimeridian.
+    '''
+    cols = [(_geocell_col(west), _geocell_col(east))]
+    if float(east) - float(west) >= 360:
+        cols = [(0, GEOCELL_COLS - 1)]
+    elif float(west) > float(east) or cols[0][0] > cols[0][1]:
+        cols = [(cols[0][0], GEOCELL_COLS - 1), (0, cols[0][1])]
+
+    return [
+        (row * GEOCELL_COLS + first, row * GEOCELL_COLS + last)
+        for row in range(_geocell_row(south), _geocell_row(north) + 1)
+        for first, last in cols
+    ]
+
+
+#-------------------------------------------------------------------------------
+def radius_bbox(lat, lon, km):
+    '''
+    ``(south, west, north, east)`` box enclosing a circle of ``km`` around a
+    point, widened to every longitude when the circle reaches a pole.
+    '''
+    lat, lon = float(lat), float(lon)
+    dlat = km / KM_PER_DEGREE
+    south, north = lat - dlat, lat + dlat
+    if south <= -90 or north >= 90:
+        return max(south, -90), -180, min(north, 90), 180
+
+    dlon = dlat / math.cos(math.radians(max(abs(south), abs(north))))
+    if dlon >= 180:
+        return south, -180, north, 180
+
+    west, east = lon - dlon, lon + dlon
+    if west < -180:
+        west += 360
+    if east > 180:
+        east -= 360
+    return south, west, north, east
+
+
+#-------------------------------------------------------------------------------
+_tzinfos = {}
+
+def get_tzinfo(name):
+    '''
+    Memoized ``pytz.timezone``; the same handful of zones are looked up for
+    every row of a user's history.
+    '''
+    tz = _tzinfos.get(name)
+    if tz is None:
+        tz = _tzinfos[name] = pytz.timezone(name)
+    return tz
+
+
 #===============================================================================
 class TravelJsonEncoder(json.JSONEncoder):
     """
@@ -193,11 +382,29 @@ class TravelJsonEncoder(json.JSONEncoder):
 
 DATETIME_PARSERS = dict(
     datetime = lambda o: datetime.datetime.strptime(o, TravelJsonEncoder.DATETIME_FORMAT),
-    date     = lambda o: datetime.date(*[int(i) for i in o.split('/')]),
+    date     = lambda o: datetime.date(*[int(i) for i in o.split('-')]),
     time     = lambda o: datetime.time(*[int(i) for i in o.split(':')]),
     decimal  = Decimal
 )
 
+# Equivalents of ``TravelJsonEncoder.default`` and ``DATETIME_PARSERS``, keyed
+# by exact type and using isoformat and slicing in place of strftime/strptime
+FAST_ENCODERS = {
+    datetime.datetime: ('datetime', lambda o: o.isoformat()[:19] + 'Z'),
+    datetime.date: ('date', datetime.date.isoformat),
+    datetime.time: ('time', lambda o: o.isoformat()[:8]),
+    Decimal: ('decimal', str),
+}
+
+FAST_PARSERS = dict(
+    datetime = lambda o: datetime.datetime(
+        int(o[0:4]), int(o[5:7]), int(o[8:10]), int(o[11:13]), int(o[14:16]), int(o[17:19])
+    ),
+    date     = lambda o: datetime.date(int(o[0:4]), int(o[5:7]), int(o[8:10])),
+    time     = lambda o: datetime.time(int(o[0:2]), int(o[3:5]), int(o[6:8])),
+    decimal  = Decimal
+)
+
 
 #-------------------------------------------------------------------------------
 def object_hook(dct):
@@ -218,6 +425,74 @@ def json_loads(s, object_hook=object_hook, **kws):
     return json.loads(s, object_hook=object_hook, **kws)
 
 
+#-------------------------------------------------------------------------------
+def encode_columns(rows):
+    '''
+    Convert, in place, the date/time and decimal values of a list of dicts
+    (such as a ``values()`` query) to the ``content_type`` objects
+    ``TravelJsonEncoder`` would produce. Values are matched on their exact
+    type; anything else, subclasses included, is left to the encoder.
+    '''
+    for row in rows:
+        if isinstance(row, dict):
+            for key, value in row.items():
+                handler = FAST_ENCODERS.get(type(value))
+                if handler:
+                    row[key] = {'content_type': handler[0], 'value': handler[1](value)}
+    return rows
+
+
+#-------------------------------------------------------------------------------
+def decode_columns(rows):
+    '''
+    The inverse of ``encode_columns``, for lists of dicts decoded without an
+    ``object_hook``. Dicts with any other ``content_type`` are left as is.
+    '''
+    for row in rows:
+        if isinstance(row, dict):
+            for key, value in row.items():
+                if isinstance(value, dict):
+                    parse = FAST_PARSERS.get(value.get('content_type'))
+                    if parse:
+                        row[key] = parse(value['value'])
+    return rows
+
+
+#-------------------------------------------------------------------------------
+def _bulk_convert(obj, convert):
+    if isinstance(obj, dict):
+        return dict((key, _bulk_convert(value, convert)) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return convert(list(obj))
+    return obj
+
+
+#-------------------------------------------------------------------------------
+def fast_json_dumps(obj, **kws):
+    '''
+    Wire compatible with ``json_dumps``, but lists of dicts have their typed
+    columns converted in bulk (and in place) beforehand, leaving
+    ``TravelJsonEncoder.default`` for only the odd value elsewhere.
+    '''
+    kws.setdefault('separators', (',', ':'))
+    return json.dumps(_bulk_convert(obj, encode_columns), cls=TravelJsonEncoder, **kws)
+
+
+#-------------------------------------------------------------------------------
+def fast_json_loads(s, **kws):
+    '''
+    Reads ``json_dumps``/``fast_json_dumps`` output without an ``object_hook``;
+    typed values are restored in bulk within lists of dicts and at the top
+    level of dicts.
+    '''
+    data = _bulk_convert(json.loads(s, **kws), decode_columns)
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if isinstance(value, dict) and value.get('content_type') in FAST_PARSERS:
+                data[key] = FAST_PARSERS[value['content_type']](value['value'])
+    return data
+
+
 #-------------------------------------------------------------------------------
 def json_encoding_test():
     print('-' * 40)
@@ -232,7 +507,45 @@ def json_encoding_test():
     result = json_loads(out)
     print(result)
     print(result == data)
-    
+    print(fast_json_loads(fast_json_dumps(data)) == data)
+
+
+#-------------------------------------------------------------------------------
+def json_benchmark(count=20000, repeat=5):
+    import time
+    print('-' * 40)
+    when = datetime.datetime(2009, 2, 9, 8, 15)
+    def history():
+        return {
+            'entities': [
+                {'id': i, 'name': 'Entity {}'.format(i), 'lat': Decimal('12.3456'), 'lon': None}
+                for i in range(count)
+            ],
+            'logs': [
+                {'id': i, 'arrival': when + datetime.timedelta(hours=i), 'rating': 3}
+                for i in range(count)
+            ]
+        }
+
+    s = json_dumps(history())
+    timings = [
+        ('json_dumps', json_dumps, history),
+        ('fast_json_dumps', fast_json_dumps, history),
+        ('json_loads', json_loads, lambda: s),
+        ('fast_json_loads', fast_json_loads, lambda: s),
+    ]
+    for name, func, make_arg in timings:
+        elapsed = 0
+        for i in range(repeat):
+            # fast_json_dumps converts its argument in place, so build it anew
+            arg = make_arg()
+            start = time.time()
+            func(arg)
+            elapsed += time.time() - start
+        print('{:<16} {:>10.2f} ms'.format(name, elapsed / repeat * 1000))
+
+    print(fast_json_loads(fast_json_dumps(history())) == json_loads(s))
+
 
 #-------------------------------------------------------------------------------
 def lat_lon_test():
@@ -273,4 +586,5 @@ def lat_lon_test():
 ################################################################################
 if __name__ == '__main__':
     json_encoding_test()
+    json_benchmark()
     lat_lon_test()
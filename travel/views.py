@@ -4,10 +4,13 @@ from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.shortcuts import get_object_or_404, render
 from django.contrib.auth.decorators import login_required, user_passes_test
+from django.views.decorators.http import condition
 
 from travel import models as travel
 from travel import forms
 from travel import utils
+from travel import profiling
+from travel.listing import EntityListing, decode_cursor, keyset_page, stream_entities_json
 
 
 #-------------------------------------------------------------------------------
@@ -22,7 +25,53 @@ def render_travel(request, base_templates, data):
     
     custom = ['travel/custom' + base for base in base_templates]
     templates = custom + ['travel/' + base for base in base_templates]
-    return render(request, templates, data)
+    with profiling.timing(request, 'template'):
+        return render(request, templates, data)
+
+
+#-------------------------------------------------------------------------------
+def entities_json(request, qs):
+    '''
+    Stream ``qs`` as JSON in ``(name, id)`` order. ``limit`` caps the number
+    of results, and ``after`` resumes from the ``next`` cursor of a previous
+    response.
+    '''
+    try:
+        after = request.GET.get('after')
+        after = decode_cursor(after, 2) if after else None
+        limit = request.GET.get('limit')
+        limit = int(limit) if limit else None
+        if limit is not None and limit < 1:
+            raise ValueError('limit must be positive')
+    except ValueError:
+        return http.HttpResponseBadRequest('Invalid after or limit parameter')
+
+    return http.StreamingHttpResponse(
+        stream_entities_json(qs, after, limit),
+        content_type='application/json'
+    )
+
+
+#-------------------------------------------------------------------------------
+def paginate(request, places):
+    '''
+    The page of ``places`` following the request's ``after`` cursor, and the
+    query strings of the first and next pages (``None`` where there's none).
+    '''
+    after = request.GET.get('after')
+    try:
+        rows, cursor = keyset_page(places, decode_cursor(after) if after else None)
+    except ValueError:
+        raise http.Http404('Invalid after parameter')
+
+    query = request.GET.copy()
+    query.pop('after', None)
+    first_page = '?' + query.urlencode() if after else None
+    next_page = None
+    if cursor:
+        query['after'] = cursor
+        next_page = '?' + query.urlencode()
+    return rows, {'first_page': first_page, 'next_page': next_page}
 
 
 #-------------------------------------------------------------------------------
@@ -39,6 +88,32 @@ def profile(request, username):
     })
 
 
+#-------------------------------------------------------------------------------
+def _profile_history(request, username):
+    profile = get_object_or_404(travel.TravelProfile, user__username=username)
+    if not (profile.is_public or request.user == profile.user):
+        raise http.Http404
+
+    try:
+        version = int(request.GET.get('v', travel.TravelLog.HISTORY_VERSIONS[-1]))
+    except ValueError:
+        version = None
+
+    if version not in travel.TravelLog.HISTORY_VERSIONS:
+        raise http.Http404('Unknown history version')
+
+    return travel.TravelLog.objects.history(profile.user, version)
+
+
+#-------------------------------------------------------------------------------
+@condition(etag_func=lambda request, username: _profile_history(request, username)['etag'])
+def profile_history_json(request, username):
+    return http.HttpResponse(
+        _profile_history(request, username)['content'],
+        content_type='application/json'
+    )
+
+
 #-------------------------------------------------------------------------------
 def languages(request):
     return render_travel(request, 'languages.html', {
@@ -63,22 +138,24 @@ def bucket_lists(request):
 #-------------------------------------------------------------------------------
 def bucket_list_comparison(request, pk, usernames):
     bucket_list = get_object_or_404(travel.TravelBucketList, pk=pk)
-    entities = bucket_list.entities.select_related()
-    results = [{
-        'username': username,
-        'entities': set(travel.TravelLog.objects.filter(
-            user__username=username,
-            entity__in=entities
-        ).values_list('entity__id', flat=True))
-    } for username in usernames.split('/')]
-    
+    comparison = bucket_list.compare(usernames.split('/'))
     return render_travel(request, 'buckets/compare.html', {
         'bucket_list': bucket_list,
-        'entities': entities,
-        'results': results
+        'entities': comparison.entities,
+        'results': comparison.results
     })
 
 
+#-------------------------------------------------------------------------------
+def bucket_list_comparison_json(request, pk, usernames):
+    bucket_list = get_object_or_404(travel.TravelBucketList, pk=pk)
+    comparison = bucket_list.compare(usernames.split('/'))
+    return http.HttpResponse(
+        utils.json_dumps(comparison.as_dict(), indent=None),
+        content_type='application/json'
+    )
+
+
 #-------------------------------------------------------------------------------
 def _bucket_list_for_user(request, bucket_list, user):
     done, entities = bucket_list.user_results(user)
@@ -109,22 +186,37 @@ def search(request):
     if search_form.is_valid():
         q = search_form.cleaned_data['search']
         by_type = search_form.cleaned_data['type']
-        data.update(search=q, results=travel.TravelEntity.objects.search(q, by_type))
+        results = travel.TravelEntity.objects.search(q, by_type)
+        data.update(search=q, total=results.count())
+        data['results'], data['pages'] = paginate(request, results)
 
     return render_travel(request, 'search/search.html', data)
 
 
+#-------------------------------------------------------------------------------
+def search_json(request):
+    search_form = forms.SearchForm(request.GET)
+    results = travel.TravelEntity.objects.none()
+    if search_form.is_valid():
+        results = travel.TravelEntity.objects.search(
+            search_form.cleaned_data['search'],
+            search_form.cleaned_data['type']
+        )
+
+    return entities_json(request, results)
+
+
 #-------------------------------------------------------------------------------
 @login_required
 def search_advanced(request):
     # 'travel-search-advanced'
-    data = {'results': None, 'search': ''}
+    data = {'groups': None, 'search': ''}
     search = request.GET.get('search', '').strip()
     if search:
         lines = [line.strip() for line in search.splitlines()]
         data.update(
             search='\n'.join(lines),
-            results=travel.TravelEntity.objects.advanced_search(lines)
+            groups=travel.TravelEntity.objects.batch_search(lines)
         )
         
     return render_travel(request, 'search/advanced.html', data)
@@ -133,11 +225,21 @@ def search_advanced(request):
 #-------------------------------------------------------------------------------
 def by_locale(request, ref):
     etype = get_object_or_404(travel.TravelEntityType, abbr=ref)
-    places = list(etype.entity_set.select_related(
-        'flag', 'capital', 'state', 'country', 'continent'
-    ))
+    places = EntityListing(ref)
+    rows, pages = paginate(request, places)
     template = 'entities/listing/{}.html'.format(ref)
-    return render_travel(request, template, {'type': etype, 'places': places})
+    return render_travel(request, template, {
+        'type': etype,
+        'places': rows,
+        'total': len(places),
+        'pages': pages
+    })
+
+
+#-------------------------------------------------------------------------------
+def by_locale_json(request, ref):
+    etype = get_object_or_404(travel.TravelEntityType, abbr=ref)
+    return entities_json(request, etype.entity_set.all())
 
 
 #-------------------------------------------------------------------------------
@@ -172,7 +274,7 @@ def _handle_entity(request, ref, code, aux, handler):
     if n == 0:
         raise http.Http404
     elif n > 1:
-        return render_travel(request, 'search/search.html', {'results': entity})
+        return render_travel(request, 'search/search.html', {'results': entity, 'total': n})
     else:
         return handler(request, entity[0])
 
@@ -190,17 +292,31 @@ def entity_relationships(request, ref, code, rel, aux=None):
     if count == 0:
         raise http.Http404('No entity matches the given query.')
     elif count > 1:
-        return render_travel(request, 'search/search.html', {'results': places})
+        return render_travel(request, 'search/search.html', {'results': places, 'total': count})
 
     place = places[0]
     etype  = get_object_or_404(travel.TravelEntityType, abbr=rel)
+    related = place.related_by_type(etype)
+    rows, pages = paginate(request, related)
     return render_travel(request, 'entities/listing/{}.html'.format(rel), {
         'type': etype,
-        'places': place.related_by_type(etype),
+        'places': rows,
+        'total': related.count(),
+        'pages': pages,
         'parent': place
     })
 
 
+#-------------------------------------------------------------------------------
+def entity_relationships_json(request, ref, code, rel, aux=None):
+    places = list(travel.TravelEntity.objects.find(ref, code, aux)[:2])
+    if len(places) != 1:
+        raise http.Http404('No single entity matches the given query.')
+
+    etype = get_object_or_404(travel.TravelEntityType, abbr=rel)
+    return entities_json(request, places[0].related_by_type(etype))
+
+
 #-------------------------------------------------------------------------------
 def log_entry(request, username, pk):
     entry = get_object_or_404(travel.TravelLog, user__username=username, pk=pk)
@@ -231,7 +347,9 @@ def _entity_edit(request, entity, template='entities/edit.html'):
         form = forms.EditTravelEntityForm(request.POST, instance=entity)
         if form.is_valid():
             form.save()
-            return http.HttpResponseRedirect(entity.get_absolute_url())
+            # unless a flag updated inline failed
+            if not form.errors:
+                return http.HttpResponseRedirect(entity.get_absolute_url())
     else:
         form = forms.EditTravelEntityForm(instance=entity)
 
@@ -272,7 +390,8 @@ def add_entity_co(request, template='entities/add/add.html'):
         form = forms.NewCountryForm(request.POST)
         if form.is_valid():
             entity = form.save(entity_type)
-            return http.HttpResponseRedirect(entity.get_absolute_url())
+            if not form.errors:
+                return http.HttpResponseRedirect(entity.get_absolute_url())
     else:
         form = forms.NewCountryForm()
         
@@ -289,7 +408,8 @@ def add_entity_by_co(request, code, abbr, template='entities/add/add.html'):
         form = forms.NewTravelEntityForm(request.POST)
         if form.is_valid():
             entity = form.save(entity_type, country=country)
-            return http.HttpResponseRedirect(entity.get_absolute_url())
+            if not form.errors:
+                return http.HttpResponseRedirect(entity.get_absolute_url())
     else:
         form = forms.NewTravelEntityForm()
     